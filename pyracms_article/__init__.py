@@ -1,10 +1,26 @@
-from .views import article_read
+from .lib.cachelib import configure_caches
+from .lib.pagecache import page_cache
+from .lib.viewcounter import view_counter
+from .lib.instrument import before_render
+from .lib.menucache import menu_cache
+from .views import article_metrics, article_read
+from pyramid.events import BeforeRender
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
 def includeme(config):
     """ Activate the forum; usually called via
     ``config.include('pyracms_forum')`` instead of being invoked
     directly. """
     config.include('pyramid_jinja2')
     config.add_jinja2_search_path("pyracms_article:templates")
+    settings = config.get_settings()
+    configure_caches(settings)
+    page_cache.configure(settings)
+    menu_cache.configure(int(settings.get("article_menu_cache_ttl", 60)),
+                         int(settings.get("article_menu_cache_size", 256)))
+    view_counter.configure(
+        int(settings.get("article_view_count_interval", 60)),
+        int(settings.get("article_view_count_threshold", 1000)))
     
     # Userarea Admin Routes
     config.add_route('userarea_admin_backup_articles',
@@ -13,7 +29,7 @@ def includeme(config):
                      '/userarea_admin/restore_articles')
     
     # Article Routes
-    if config.get_settings().get("enable_pyracms_article_home"):
+    if settings.get("enable_pyracms_article_home"):
         config.add_view(article_read, route_name='home', 
                         renderer='article/article.jinja2', 
                         permission='article_view')
@@ -27,6 +43,8 @@ def includeme(config):
     config.add_route('article_delete', '/article/delete/{page_id}')
     config.add_route('article_create', '/article/create/{page_id}')
     config.add_route('article_update', '/article/update/{page_id}')
+    config.add_route('article_diff',
+                     '/article/diff/{page_id}/{rev_a}/{rev_b}')
     config.add_route('article_list_revisions',
                      '/article/list_revisions/{page_id}')
     config.add_route('article_switch_renderer',
@@ -35,6 +53,16 @@ def includeme(config):
     config.add_route('article_hide_display_name',
                      '/article/hide_display_name/{page_id}')
     config.add_route('article_add_vote', '/vote/article/{vote_id}/{like}')
+    config.add_route('article_stats', '/article/stats')
+    if asbool(settings.get("article_instrument", False)):
+        config.add_tween(
+            "pyracms_article.lib.instrument.instrument_tween_factory")
+        config.add_subscriber(before_render, BeforeRender)
+        public = asbool(settings.get("article_metrics_public", False))
+        config.add_view(article_metrics, route_name='article_metrics',
+                        permission=(NO_PERMISSION_REQUIRED if public
+                                    else 'article_mod'))
+        config.add_route('article_metrics', '/article/metrics')
     
     config.scan("pyracms_article.views")
     config.scan("pyracms_article.web_service_views")
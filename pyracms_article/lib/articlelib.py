@@ -1,18 +1,32 @@
 from ..models import (ArticleRevision, ArticlePage, ArticleRenderers, 
-    ArticleTags, ArticleVotes)
+    ArticleTags, ArticleTagCount, ArticleVotes, ArticleIndexQueue)
+from .cachelib import diff_cache, render_cache, text_cache
+from .instrument import timed
+from .pagecache import page_cache
+from .revisiondiff import diff_texts
+from .revisionstore import SNAPSHOTS, unpack
 from jinja2.filters import do_striptags
-from pyracms.lib.helperlib import serialize_relation
 from pyracms.lib.searchlib import SearchLib
 from pyracms.lib.settingslib import SettingsLib
 from pyracms.lib.taglib import TagLib, ARTICLE
 from pyracms.lib.userlib import UserLib
 from pyracms.lib.widgetlib import WidgetLib
-from pyracms.models import DBSession
+from pyracms.models import DBSession, User
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_registry
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql.expression import and_, desc, or_, select
+from sqlalchemy.sql.functions import func
+from zope.sqlalchemy import mark_changed
+import base64
 import datetime
+import gzip
+import hashlib
+import io
 import json
-import transaction
+import zlib
 
 class RevisionNotFound(Exception):
     pass
@@ -26,8 +40,219 @@ class PageFound(Exception):
 class AlreadyVoted(Exception):
     pass
 
+class InvalidCursor(Exception):
+    pass
+
 s = SettingsLib()
 
+# Columns left out of backups, they are derived and rebuilt on restore
+EXPORT_EXCLUDE = ("name_lower", "html", "plain", "html_renderer_id",
+                  "up_count", "down_count", "storage", "data", "base_id",
+                  "index_hash", "index_meta_hash", "current_revision_id")
+
+def get_setting(name, default=None):
+    """
+    Get a setting from the application's ini file.
+    """
+    settings = get_current_registry().settings or {}
+    return settings.get(name, default)
+
+def encode_cursor(*values):
+    """
+    Encode keyset pagination values as an opaque url safe string.
+    """
+    data = [{"d": value.isoformat()} if isinstance(value, datetime.datetime)
+            else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+def decode_cursor(cursor, *types):
+    """
+    Decode a string made by encode_cursor, holding one value of each of
+    types.
+    Raise InvalidCursor if it can't be decoded or doesn't match types.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(data, list) or len(data) != len(types):
+            raise InvalidCursor
+        values = [datetime.datetime.fromisoformat(value["d"])
+                  if isinstance(value, dict) else value for value in data]
+    except (AttributeError, ValueError, TypeError, KeyError):
+        raise InvalidCursor
+    for value, kind in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, kind):
+            raise InvalidCursor
+    return values
+
+def buffer_chunks(chunks, gzip=False, buffer_size=65536):
+    """
+    Join small text chunks into byte strings of about buffer_size,
+    optionally gzip compressed, for use as a WSGI app_iter.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        chunk = chunk.encode("utf-8")
+        if compressor:
+            chunk = compressor.compress(chunk)
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if compressor:
+        buffer.append(compressor.flush())
+    if buffer:
+        yield b"".join(buffer)
+
+def execute(*args):
+    """
+    Run a statement through the session, marking the session as changed
+    so the transaction commits it.
+    """
+    result = DBSession.execute(*args)
+    mark_changed(DBSession())
+    return result
+
+def insert_ignore(table, index_elements, **values):
+    """
+    Insert a row unless it would break a unique constraint on
+    index_elements, without waiting on or aborting a concurrent insert
+    of the same row. Returns the number of rows inserted.
+    """
+    dialect = DBSession.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return execute(insert(table).values(**values).on_conflict_do_nothing(
+                            index_elements=index_elements)).rowcount
+    if dialect == "mysql":
+        return execute(table.insert().prefix_with("IGNORE"
+                                                  ).values(**values)).rowcount
+    if dialect == "sqlite":
+        return execute(table.insert().prefix_with("OR IGNORE"
+                                                  ).values(**values)).rowcount
+    try:
+        with DBSession.begin_nested():
+            return execute(table.insert().values(**values)).rowcount
+    except IntegrityError:
+        return 0
+
+def count_votes_statement(page_ids=None):
+    """
+    Make an update that recounts vote tallies from the votes table.
+    """
+    pages = ArticlePage.__table__
+    votes = ArticleVotes.__table__
+    def tally(like):
+        return select(func.count(votes.c.id)).where(
+            and_(votes.c.page_id == pages.c.id,
+                 votes.c.like == like)).scalar_subquery()
+    statement = pages.update().values(up_count=tally(True),
+                                      down_count=tally(False))
+    if page_ids is not None:
+        statement = statement.where(pages.c.id.in_(page_ids))
+    return statement
+
+def count_tags_select():
+    """
+    Make a select of tag names and the number of public pages with each.
+    """
+    pages = ArticlePage.__table__
+    tags = ArticleTags.__table__
+    return select(tags.c.name, func.count(func.distinct(tags.c.page_id))
+        ).select_from(tags.join(pages, tags.c.page_id == pages.c.id)
+        ).where(or_(pages.c.private == False, pages.c.private == None)
+        ).group_by(tags.c.name)
+
+def convert_date(date):
+    """
+    Convert a date from a backup back to a datetime.
+    """
+    if isinstance(date, str):
+        date = date.split(".")[0]
+    date_format = "%Y-%m-%dT%H:%M:%S"
+    try:
+        return datetime.datetime.strptime(date, date_format)
+    except TypeError:
+        return datetime.datetime(1900, 1, 1)
+    except ValueError:
+        return datetime.datetime(1900, 1, 1)
+
+def iter_backup(fp, chunk_size=65536):
+    """
+    Read pages one at a time from a backup file object, which may hold
+    a JSON array or one page per line and may be gzip compressed.
+    """
+    head = fp.read(2)
+    if isinstance(head, bytes):
+        compressed = head == b"\x1f\x8b"
+        fp = io.BufferedReader(ChainedReader(head, fp))
+        if compressed:
+            fp = gzip.GzipFile(fileobj=fp)
+        fp = io.TextIOWrapper(fp, encoding="utf-8")
+        head = ""
+    decoder = json.JSONDecoder()
+    buffer = head
+    eof = False
+    read_size = chunk_size
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,[")
+        if buffer.startswith("]"):
+            return
+        if buffer:
+            try:
+                row, end = decoder.raw_decode(buffer)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield row
+                buffer = buffer[end:]
+                read_size = chunk_size
+                continue
+        elif eof:
+            return
+        data = fp.read(read_size)
+        if not data:
+            eof = True
+        buffer += data
+        # Grow reads while a large page is incomplete, so it isn't
+        # parsed again for every chunk.
+        read_size *= 2
+
+def fill_missing(rows):
+    """
+    Give every row the same keys, for an executemany insert.
+    """
+    keys = set()
+    for row in rows:
+        keys.update(row)
+    for row in rows:
+        for key in keys.difference(row):
+            row[key] = None
+    return rows
+
+class ChainedReader(io.RawIOBase):
+    """
+    A raw binary stream that puts back bytes already read from a file.
+    """
+
+    def __init__(self, head, fp):
+        self.head = head
+        self.fp = fp
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.head or self.fp.read(len(buffer))
+        self.head = data[len(buffer):] if self.head else b""
+        data = data[:len(buffer)]
+        buffer[:len(data)] = data
+        return len(data)
+
 class ArticleLib():
     """
     A library to manage the article database.
@@ -37,38 +262,318 @@ class ArticleLib():
         self.t = TagLib(ArticleTags, ARTICLE)
         self.s = SearchLib()
         
+    @timed("list")
     def list(self): #@ReservedAssignment
         """
         List all the pages
         """
-        pages = DBSession.query(ArticlePage)
-        if not pages:
-            raise PageNotFound
-        return [(page.name, page.display_name or page.name) for page in pages]
+        pages = DBSession.query(ArticlePage.name, ArticlePage.display_name)
+        return [(name, display_name or name) for name, display_name in pages]
+
+    def list_sort_column(self, sort):
+        """
+        Get the column to sort page lists by. Nullable columns sort as
+        their default, so every row has a key a cursor can hold.
+        Raise ValueError if sort is unknown.
+        """
+        if sort == "name":
+            return ArticlePage.name
+        elif sort == "created":
+            return func.coalesce(ArticlePage.created,
+                                 datetime.datetime(1900, 1, 1))
+        elif sort == "view_count":
+            return func.coalesce(ArticlePage.view_count, 0)
+        elif sort == "votes":
+            return ArticlePage.up_count
+        raise ValueError("Unknown sort %s" % sort)
+
+    @timed("list")
+    def list_pages(self, limit=100, cursor=None, sort="name",
+                   descending=False, tag=None, owner=None, private=None):
+        """
+        List a page of pages, selecting only the columns needed.
+        Pages can be sorted by name, created, view_count or votes, and
+        filtered by tag, owner's username and private flag.
+        Returns rows and a cursor for the next page of rows, or None.
+        Raise ValueError for an unknown sort, InvalidCursor if cursor
+        is malformed.
+        """
+        sort_column = self.list_sort_column(sort)
+        query = DBSession.query(ArticlePage.id, ArticlePage.name,
+                                ArticlePage.display_name,
+                                ArticlePage.created, ArticlePage.view_count,
+                                ArticlePage.up_count, ArticlePage.down_count,
+                                ArticlePage.private,
+                                sort_column.label("sort_key"))
+        if tag:
+            query = query.filter(ArticlePage.tags.any(ArticleTags.name == tag))
+        if owner:
+            query = query.filter(ArticlePage.user.has(User.name == owner))
+        if private is not None:
+            query = query.filter(ArticlePage.private == private)
+        if cursor:
+            key, page_id = decode_cursor(cursor,
+                                         sort_column.type.python_type, int)
+            if descending:
+                query = query.filter(or_(sort_column < key,
+                                         and_(sort_column == key,
+                                              ArticlePage.id < page_id)))
+            else:
+                query = query.filter(or_(sort_column > key,
+                                         and_(sort_column == key,
+                                              ArticlePage.id > page_id)))
+        if descending:
+            query = query.order_by(desc(sort_column), desc(ArticlePage.id))
+        else:
+            query = query.order_by(sort_column, ArticlePage.id)
+        rows = query.limit(limit + 1).all()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].sort_key, rows[-1].id)
+
+    def set_tags(self, page, tags):
+        """
+        Set a page's tags from a space separated string, only adding
+        and removing the tags that changed and keeping tag counts up to
+        date. Returns True if any tag changed.
+        """
+        names = []
+        for name in (tags or "").split():
+            if name not in names:
+                names.append(name)
+        current = {}
+        for tag in page.tags:
+            current.setdefault(tag.name, []).append(tag)
+        removed = [name for name in current if name not in names]
+        added = [name for name in names if name not in current]
+        for name in removed:
+            for tag in current[name]:
+                page.tags.remove(tag)
+        for name in added:
+            page.tags.append(ArticleTags(name))
+        if not page.private:
+            self.adjust_tag_counts(added, 1)
+            self.adjust_tag_counts(removed, -1)
+        return bool(added or removed)
 
+    def adjust_tag_counts(self, names, delta):
+        """
+        Add delta to the public page count of each tag.
+        """
+        if not names:
+            return
+        counts = ArticleTagCount.__table__
+        if delta > 0:
+            for name in names:
+                insert_ignore(counts, ["name"], name=name, count=0)
+        execute(counts.update().where(counts.c.name.in_(names)
+                                      ).values(count=counts.c.count + delta))
+        if delta < 0:
+            execute(counts.delete().where(and_(counts.c.name.in_(names),
+                                               counts.c.count <= 0)))
+
+    @timed("list")
+    def tag_counts(self, limit=100):
+        """
+        List tag names and public page counts, most used first, for a
+        tag cloud.
+        """
+        return DBSession.query(ArticleTagCount.name, ArticleTagCount.count
+                    ).filter(ArticleTagCount.count > 0
+                    ).order_by(desc(ArticleTagCount.count),
+                               ArticleTagCount.name).limit(limit).all()
+
+    @timed("list")
+    def related_pages(self, page, limit=10):
+        """
+        List public pages sharing tags with a page, most shared tags
+        first, as rows of name, display_name and shared.
+        """
+        theirs = aliased(ArticleTags)
+        ours = aliased(ArticleTags)
+        shared = func.count(func.distinct(theirs.name)).label("shared")
+        return DBSession.query(ArticlePage.name, ArticlePage.display_name,
+                               shared
+                    ).join(theirs, theirs.page_id == ArticlePage.id
+                    ).join(ours, and_(ours.name == theirs.name,
+                                      ours.page_id == page.id)
+                    ).filter(ArticlePage.id != page.id
+                    ).filter(or_(ArticlePage.private == False,
+                                 ArticlePage.private == None)
+                    ).group_by(ArticlePage.id, ArticlePage.name,
+                               ArticlePage.display_name
+                    ).order_by(desc(shared), ArticlePage.name
+                    ).limit(limit).all()
+
+    @timed("index")
     def update_article_index(self, request, page, revision, username):
         """
-        Update search index
+        Update search index, unless the page's plain text and metadata
+        are the same as when it was last indexed.
         """
-        w = WidgetLib()
-        rendered = ""
-        try:
-            rendered = do_striptags(w.render_article(page, revision.article))
-        except:
-            pass
+        rendered = revision.plain
+        if not self.has_html(page, revision):
+            try:
+                rendered = do_striptags(self.render(page, revision))
+            except:
+                rendered = ""
+        tags = self.t.get_tags(page)
+        hashes = self.index_hashes(page, rendered, tags)
+        if hashes == (page.index_hash, page.index_meta_hash):
+            return
         self.s.update_index(page.display_name, 
                             request.route_url("article_read", 
                                               page_id=page.name), rendered, 
-                            self.t.get_tags(page), revision.created, 
+                            tags, revision.created, 
                             "article", page.name, username)
+        page.index_hash, page.index_meta_hash = hashes
+
+    def index_hashes(self, page, plain, tags):
+        """
+        Hash the plain text and the metadata of a page as indexed.
+        """
+        meta = "\0".join([page.name, page.display_name or "", str(tags)])
+        return (hashlib.sha1((plain or "").encode("utf-8")).hexdigest(),
+                hashlib.sha1(meta.encode("utf-8")).hexdigest())
+
+    @timed("index")
+    def index_page(self, request, page, revision, username):
+        """
+        Update the search index now, or queue the page for the index
+        worker if article_index_queue is set.
+        """
+        if not asbool(get_setting("article_index_queue", False)):
+            self.update_article_index(request, page, revision, username)
+            return
+        if page.id is None:
+            DBSession.flush()
+        self.queue_index(page.id)
+
+    def queue_index(self, page_id, attempts=0, run_after=None,
+                    last_error=None):
+        """
+        Add a page to the index queue. A page is only queued once, so
+        edits made before the worker gets to it are indexed together.
+        """
+        queue = ArticleIndexQueue.__table__
+        values = {"attempts": attempts, "last_error": last_error,
+                  "run_after": run_after or datetime.datetime.now()}
+        if not insert_ignore(queue, ["page_id"], page_id=page_id,
+                             created=datetime.datetime.now(), **values):
+            execute(queue.update().where(
+                        queue.c.page_id == page_id).values(**values))
 
-    def switch_renderer(self, name):
-        page = self.show_page(name)
+    def queue_index_multi(self, page_ids):
+        """
+        Add many pages to the index queue, resetting pages already in it.
+        """
+        queue = ArticleIndexQueue.__table__
+        page_ids = set(page_ids)
+        now = datetime.datetime.now()
+        queued = set([page_id for page_id, in execute(
+                select(queue.c.page_id).where(queue.c.page_id.in_(page_ids)))])
+        values = {"attempts": 0, "last_error": None, "run_after": now}
+        if queued:
+            execute(queue.update().where(
+                        queue.c.page_id.in_(queued)).values(**values))
+        if page_ids - queued:
+            execute(queue.insert(), [dict(page_id=page_id, created=now,
+                                          **values)
+                                     for page_id in page_ids - queued])
+
+    def index_queue_depth(self):
+        """
+        Count pages waiting to be indexed.
+        """
+        return DBSession.query(ArticleIndexQueue).count()
+
+    def process_index_queue(self, request, limit=10):
+        """
+        Index up to limit queued pages with their latest revision.
+        Failed pages are retried later with exponential back off.
+        Returns the number of jobs processed.
+        """
+        now = datetime.datetime.now()
+        jobs = DBSession.query(ArticleIndexQueue).filter(
+                ArticleIndexQueue.run_after <= now).order_by(
+                ArticleIndexQueue.run_after).limit(limit).with_for_update(
+                skip_locked=True).all()
+        for job in jobs:
+            try:
+                page = DBSession.query(ArticlePage).filter_by(
+                                                    id=job.page_id).first()
+                if page is not None and not page.private:
+                    revision = self.current_revision(page)
+                    self.update_article_index(request, page, revision,
+                                              revision.user.name)
+                DBSession.delete(job)
+            except Exception as e:
+                job.attempts += 1
+                delay = min(30 * 2 ** job.attempts, 3600)
+                job.run_after = now + datetime.timedelta(seconds=delay)
+                job.last_error = str(e)
+        return len(jobs)
+
+    @timed("render")
+    def prerender(self, page, revision):
+        """
+        Store rendered html and plain text on a revision, so reads
+        don't have to call the renderer.
+        """
+        try:
+            html = WidgetLib().render_article(page.renderer.name,
+                                              revision.article)
+        except Exception:
+            return
+        revision.html = html
+        revision.plain = do_striptags(html)
+        revision.html_renderer_id = page.renderer.id
+
+    @timed("render")
+    def render(self, page, revision):
+        """
+        Render a revision with the page's renderer. Stored html is used
+        when it is current, otherwise the result is cached by revision id
+        and renderer name.
+        """
+        if self.has_html(page, revision):
+            return revision.html
+        renderer = page.renderer.name
+        create = lambda: WidgetLib().render_article(renderer, revision.article)
+        if revision.id is None:
+            return create()
+        return render_cache.get_or_create((revision.id, renderer), create)
+
+    def has_html(self, page, revision):
+        """
+        Check if a revision has stored html made by the page's renderer.
+        """
+        return (revision.html is not None and
+                revision.html_renderer_id == page.renderer.id)
+
+    def invalidate_render_cache(self, page):
+        """
+        Drop every cached rendering of a page.
+        """
+        revision_ids = DBSession.query(ArticleRevision.id).filter_by(
+                                                        page_id=page.id)
+        renderers = [r.name for r in DBSession.query(ArticleRenderers.name)]
+        render_cache.delete_multi([(revision_id, renderer)
+                                   for revision_id, in revision_ids
+                                   for renderer in renderers])
+
+    def switch_renderer(self, name, request=None):
+        page = self.show_page(name, request)
+        page_cache.purge(page.name)
         renderer_count = DBSession.query(ArticleRenderers).count()
         if page.renderer_id == renderer_count:
-            page.renderer_id = 1
-            return
-        page.renderer_id += 1
+            renderer_id = 1
+        else:
+            renderer_id = page.renderer_id + 1
+        page.renderer = DBSession.query(ArticleRenderers).filter_by(
+                                                        id=renderer_id).one()
+        self.prerender(page, self.current_revision(page))
 
     def add_addons(self, page, name, display_name, user):
         if s.has_setting("PYRACMS_FORUM"):
@@ -88,36 +593,149 @@ class ArticleLib():
         Raise PageFound if page exists
         """
         try:
-            self.show_page(name)
+            self.show_page(name, request)
             raise PageFound
         except PageNotFound:
             pass
+        return self.add_page(request, name, display_name, article, summary,
+                             user, tags)
+
+    def default_renderer(self):
+        return DBSession.query(ArticleRenderers).filter_by(
+                            name=s.show_setting("DEFAULTRENDERER")).one()
+
+    @timed("create")
+    def add_page(self, request, name, display_name, article, summary, user,
+                 tags='', renderer=None, index=True):
+        """
+        Add a new page without checking if it exists.
+        Returns the page.
+        """
         page = ArticlePage(name, display_name)
         page.user = user
         revision = ArticleRevision(article, summary, user)
+        self.store_revision(revision, None)
         page.revisions.append(revision)
-        default_renderer = s.show_setting("DEFAULTRENDERER")
-        page.renderer = DBSession.query(ArticleRenderers).filter_by(
-                                                name=default_renderer).one()
+        page.current_revision = revision
+        page.renderer = renderer or self.default_renderer()
         page = self.add_addons(page, name, display_name, user)
-        self.t.set_tags(page, tags)
-        self.update_article_index(request, page, revision, user.name)
+        self.prerender(page, revision)
+        self.set_tags(page, tags)
         DBSession.add(page)
+        page_cache.purge(name)
+        if index:
+            self.index_page(request, page, revision, user.name)
+        return page
 
-    def update(self, request, page, article, summary, user, tags=''):
+    @timed("update")
+    def update(self, request, page, article, summary, user, tags='',
+               index=True):
         """
         Update a page
         Raise PageNotFound if page does not exist
         """
         if not article:
-            self.delete(page, user)
+            self.delete(request, page)
             return
-        self.t.set_tags(page, tags)
+        page_cache.purge(page.name)
+        self.set_tags(page, tags)
+        previous = page.current_revision
         revision = ArticleRevision(article, summary, user)
+        self.store_revision(revision, previous)
         revision.page = page
-        if not page.private:
-            self.update_article_index(request, page, revision, user.name)
+        page.current_revision = revision
+        if (previous is not None and self.has_html(page, previous) and
+                previous.article == article):
+            revision.html = previous.html
+            revision.plain = previous.plain
+            revision.html_renderer_id = previous.html_renderer_id
+        else:
+            self.prerender(page, revision)
         DBSession.add(revision)
+        if index and not page.private:
+            self.index_page(request, page, revision, user.name)
+
+    @timed("bulk_save")
+    def bulk_save(self, request, items, user, can_create=True,
+                  can_update=True, is_mod=False):
+        """
+        Create or update many pages in the current transaction. Items
+        are dicts of page_id, display_name, article, summary and tags.
+        Existing pages are loaded in one query and search indexing is
+        done in one pass at the end, but each update still stores its
+        revision like update does. Users may only update their own
+        pages unless is_mod is set.
+        Returns a dict of page_id and status, or error, for each item.
+        """
+        pages = self.show_pages([item['page_id'] for item in items], request)
+        renderer = None
+        to_index = {}
+        results = []
+        for item in items:
+            name = item['page_id']
+            page = pages.get(name)
+            if page is None:
+                if not can_create:
+                    results.append({'page_id': name, 'error': 'access_denied'})
+                    continue
+                if renderer is None:
+                    renderer = self.default_renderer()
+                page = pages[name] = self.add_page(
+                    request, name, item['display_name'], item['article'],
+                    item['summary'], user, item['tags'], renderer, False)
+                to_index[name] = (page, user.name)
+                results.append({'page_id': name, 'status': 'created'})
+                continue
+            if not can_update or not (is_mod or page.user == user):
+                results.append({'page_id': name, 'error': 'access_denied'})
+                continue
+            page.display_name = item['display_name']
+            self.update(request, page, item['article'], item['summary'],
+                        user, item['tags'], False)
+            if not page.private:
+                to_index[name] = (page, user.name)
+            results.append({'page_id': name, 'status': 'updated'})
+        self.index_batch(request, [(page, page.current_revision, username)
+                                   for page, username in to_index.values()])
+        return results
+
+    def index_batch(self, request, entries):
+        """
+        Index many (page, revision, username) entries, or queue them
+        all with a few statements if article_index_queue is set.
+        """
+        if not entries:
+            return
+        if asbool(get_setting("article_index_queue", False)):
+            DBSession.flush()
+            self.queue_index_multi([page.id for page, revision, username
+                                    in entries])
+            return
+        for page, revision, username in entries:
+            self.update_article_index(request, page, revision, username)
+
+    def store_revision(self, revision, previous):
+        """
+        Store a new revision as a delta against the latest snapshot,
+        starting a new snapshot every article_snapshot_interval revisions.
+        Text is zlib compressed unless article_revision_compress is false.
+        """
+        interval = int(get_setting("article_snapshot_interval", 20))
+        compress = asbool(get_setting("article_revision_compress", True))
+        base = None
+        if interval > 1 and previous is not None and previous.id:
+            with DBSession.no_autoflush:
+                if previous.storage in SNAPSHOTS:
+                    base = previous
+                else:
+                    base = DBSession.query(ArticleRevision).filter_by(
+                                                id=previous.base_id).first()
+                if base is not None:
+                    deltas = DBSession.query(func.count(ArticleRevision.id)
+                        ).filter(ArticleRevision.base_id == base.id).scalar()
+                    if deltas >= interval - 1:
+                        base = None
+        revision.pack(base, compress)
 
     def revert(self, request, page, revision, user):
         """
@@ -138,6 +756,20 @@ class ArticleLib():
         if page.album_id != -1:
             from pyracms_gallery.lib.gallerylib import GalleryLib
             GalleryLib().delete_album(page.album_id, request)
+        if not page.private:
+            self.adjust_tag_counts(list(set([tag.name for tag in page.tags])),
+                                   -1)
+        self.invalidate_render_cache(page)
+        page_cache.purge(page.name)
+        revision_ids = set([revision_id for revision_id, in
+                            DBSession.query(ArticleRevision.id).filter_by(
+                                                        page_id=page.id)])
+        text_cache.delete_multi(revision_ids)
+        diff_cache.delete_if(lambda key: key[0] in revision_ids or
+                                         key[1] in revision_ids)
+        self.forget_page(request, page)
+        execute(ArticleIndexQueue.__table__.delete().where(
+                        ArticleIndexQueue.page_id == page.id))
         DBSession.delete(page)
         self.s.delete_from_index(request.route_url("article_read", 
                                                    page_id=page.name))
@@ -147,19 +779,32 @@ class ArticleLib():
         Flip private switch.
         Raise PageNotFound if page does not exist.
         """
-        page = self.show_page(name)
+        page = self.show_page(name, request)
         page.private = not page.private
+        page.index_hash = page.index_meta_hash = None
+        self.adjust_tag_counts(list(set([tag.name for tag in page.tags])),
+                               -1 if page.private else 1)
+        page_cache.purge(page.name)
         self.s.delete_from_index(request.route_url("article_read", 
                                                    page_id=page.name))
 
-    def hide_display_name(self, name):
+    def hide_display_name(self, name, request=None):
         """
         Flip hide display name switch.
         Raise PageNotFound if page does not exist.
         """
-        page = self.show_page(name)
+        page = self.show_page(name, request)
         page.hide_display_name = not page.hide_display_name
+        page_cache.purge(page.name)
+
+    @timed("current_revision")
+    def current_revision(self, page):
+        """
+        Get the latest revision of a page.
+        """
+        return page.current_revision or page.revisions[0]
 
+    @timed("show_revision")
     def show_revision(self, page, revision, error=False):
         """
         Get revision objects.
@@ -173,97 +818,466 @@ class ArticleLib():
             else:
                 pass
 
-    def show_page(self, name):
+    @timed("diff")
+    def diff(self, page, rev_a, rev_b):
+        """
+        Diff two revisions of a page, see revisiondiff.diff_texts.
+        Revisions never change, so diffs are cached by revision pair.
+        Raise RevisionNotFound if either revision does not exist.
+        """
+        old = self.show_revision(page, rev_a, True)
+        new = self.show_revision(page, rev_b, True)
+        return diff_cache.get_or_create((old.id, new.id), lambda: diff_texts(
+            old.article, new.article,
+            max_lines=int(get_setting("article_diff_max_lines", 2000))))
+
+    @timed("list_revisions")
+    def list_revisions(self, page, limit=None, cursor=None):
+        """
+        List revision id, summary, created and username for a page,
+        newest first, in one query without loading article text.
+        Returns rows and a cursor for the next page of rows, or None.
+        Raise InvalidCursor if cursor is malformed.
+        """
+        query = DBSession.query(ArticleRevision.id, ArticleRevision.summary,
+                                ArticleRevision.created,
+                                User.name.label("username")
+                    ).join(User, ArticleRevision.user_id == User.id
+                    ).filter(ArticleRevision.page_id == page.id)
+        if cursor:
+            created, revision_id = decode_cursor(cursor, datetime.datetime,
+                                                 int)
+            query = query.filter(or_(
+                ArticleRevision.created < created,
+                and_(ArticleRevision.created == created,
+                     ArticleRevision.id < revision_id)))
+        query = query.order_by(desc(ArticleRevision.created),
+                               desc(ArticleRevision.id))
+        if not limit:
+            return query.all(), None
+        rows = query.limit(limit + 1).all()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].created, rows[-1].id)
+
+    @timed("show_page")
+    def show_page(self, name, request=None):
         """
         Get page objects.
+        Pages are remembered for the rest of the request if one is given,
+        by the exact name asked for. With case insensitive names, every
+        page matching the lower case name is remembered too, so other
+        spellings need no query but still prefer an exact match.
         Raise PageNotFound if page does not exist.
         """
-        try:
-            page = DBSession.query(ArticlePage
-                                   ).filter(ArticlePage.name.like(name)).one()
-        except NoResultFound:
+        case_insensitive = asbool(get_setting(
+                                    "article_case_insensitive_names", False))
+        key = ("lower", name.lower())
+        memo = None
+        if request is not None:
+            memo = getattr(request, "article_pages", None)
+            if memo is None:
+                memo = request.article_pages = {}
+            if name in memo:
+                return memo[name]
+        if case_insensitive and memo is not None and key in memo:
+            pages = memo[key]
+        else:
+            query = DBSession.query(ArticlePage).options(
+                                    joinedload(ArticlePage.current_revision),
+                                    joinedload(ArticlePage.renderer))
+            if case_insensitive:
+                pages = query.filter(ArticlePage.name_lower == key[1]).all()
+                if pages and memo is not None:
+                    memo[key] = pages
+            else:
+                pages = query.filter(ArticlePage.name == name).all()
+        if not pages:
             raise PageNotFound
+        exact = [page for page in pages if page.name == name]
+        page = (exact or pages)[0]
+        if memo is not None:
+            memo[name] = page
         return page
 
+    @timed("show_page")
+    def show_pages(self, names, request=None):
+        """
+        Get many page objects with their current revision and renderer
+        in one query. Delta revisions have their base text loaded in one
+        more query. Pages are remembered for the rest of the request if
+        one is given.
+        Returns a dict of pages by name, missing pages are left out.
+        """
+        case_insensitive = asbool(get_setting(
+                                    "article_case_insensitive_names", False))
+        query = DBSession.query(ArticlePage).options(
+                                joinedload(ArticlePage.current_revision),
+                                joinedload(ArticlePage.renderer))
+        if case_insensitive:
+            keys = set([name.lower() for name in names])
+            pages = query.filter(ArticlePage.name_lower.in_(keys)).all()
+        else:
+            pages = query.filter(ArticlePage.name.in_(set(names))).all()
+        by_name = {}
+        by_key = {}
+        for page in pages:
+            by_name[page.name] = page
+            if case_insensitive:
+                by_key.setdefault(page.name_lower, page)
+        result = {}
+        for name in names:
+            page = by_name.get(name)
+            if page is None and case_insensitive:
+                page = by_key.get(name.lower())
+            if page is not None:
+                result[name] = page
+        self.load_base_texts([page.current_revision for page in pages
+                              if page.current_revision is not None])
+        if request is not None:
+            memo = getattr(request, "article_pages", None)
+            if memo is None:
+                memo = request.article_pages = {}
+            for name, page in result.items():
+                memo[name] = page
+            if case_insensitive:
+                lower = {}
+                for page in pages:
+                    lower.setdefault(("lower", page.name_lower), []
+                                     ).append(page)
+                memo.update(lower)
+        return result
+
+    def load_base_texts(self, revisions):
+        """
+        Put the base snapshot text of delta revisions in the text
+        cache with one query, so reading their text needs no more.
+        """
+        base_ids = set([revision.base_id for revision in revisions
+                        if revision.storage not in SNAPSHOTS and
+                        revision.base_id is not None and
+                        text_cache.get(revision.id) is None and
+                        text_cache.get(revision.base_id) is None])
+        if not base_ids:
+            return
+        for base in DBSession.query(ArticleRevision).filter(
+                                    ArticleRevision.id.in_(base_ids)):
+            text_cache.set(base.id, base.article)
+
+    @timed("list_revisions")
+    def list_revisions_multi(self, page_ids):
+        """
+        List revision id, summary, created and username for many pages
+        in one query, newest first.
+        Returns a dict of row lists by page id.
+        """
+        result = dict([(page_id, []) for page_id in page_ids])
+        if not result:
+            return result
+        query = DBSession.query(ArticleRevision.id, ArticleRevision.page_id,
+                                ArticleRevision.summary,
+                                ArticleRevision.created,
+                                User.name.label("username")
+                    ).join(User, ArticleRevision.user_id == User.id
+                    ).filter(ArticleRevision.page_id.in_(list(result))
+                    ).order_by(ArticleRevision.page_id,
+                               desc(ArticleRevision.created),
+                               desc(ArticleRevision.id))
+        for row in query:
+            result[row.page_id].append(row)
+        return result
+
+    def forget_page(self, request, page=None):
+        """
+        Remove a page, or all pages, from the request's memo.
+        """
+        memo = getattr(request, "article_pages", None)
+        if not memo:
+            return
+        if page is None:
+            memo.clear()
+            return
+        for key, value in list(memo.items()):
+            if value is page or (isinstance(value, list) and page in value):
+                del memo[key]
+
     def add_vote(self, db_obj, user, like):
         """
-        Add a vote to the database
+        Add a vote to the database, or change the user's vote.
+        Raise AlreadyVoted if the user already voted the same way.
         """
-        
-        vote = ArticleVotes(user, like)
-        vote.page = db_obj
-        try:
-            DBSession.add(vote)
-            transaction.commit()
-        except IntegrityError:
-            transaction.abort()
+        if not self.set_vote(db_obj, user, like)["changed"]:
             raise AlreadyVoted
 
+    @timed("vote")
+    def set_vote(self, page, user, like):
+        """
+        Add or change a user's vote without committing, using an insert
+        that ignores duplicates and an update that only matches a changed
+        vote, so concurrent votes never wait on or abort each other.
+        Returns the page's tallies and whether anything changed.
+        """
+        votes = ArticleVotes.__table__
+        pages = ArticlePage.__table__
+        inserted = insert_ignore(votes, ["user_id", "page_id"],
+                                 page_id=page.id, user_id=user.id, like=like)
+        up = pages.c.up_count
+        down = pages.c.down_count
+        if inserted:
+            column = up if like else down
+            changes = {column: column + 1}
+        else:
+            changed = execute(votes.update().where(and_(
+                votes.c.page_id == page.id, votes.c.user_id == user.id,
+                votes.c.like != like)).values(like=like)).rowcount
+            if like:
+                changes = {up: up + 1, down: down - 1}
+            else:
+                changes = {up: up - 1, down: down + 1}
+            if not changed:
+                changes = None
+        if changes:
+            execute(pages.update().where(pages.c.id == page.id
+                                         ).values(changes))
+            page_cache.purge(page.name)
+        up_count, down_count = DBSession.query(ArticlePage.up_count,
+            ArticlePage.down_count).filter(ArticlePage.id == page.id).one()
+        return {"up_count": up_count, "down_count": down_count,
+                "like": like, "changed": bool(changes)}
+
+    @timed("vote")
+    def count_votes(self, page_ids=None):
+        """
+        Recount up_count and down_count from the votes table, for the
+        given pages or all pages.
+        """
+        execute(count_votes_statement(page_ids))
+
     def to_json(self):
-        pages = DBSession.query(ArticlePage)
-        items = serialize_relation(pages)
-        result = []
-        for item in items:
-            item['revisions'] = serialize_relation(self.show_page(item["name"]
-                                                                  ).revisions)
-            result.append(item)
+        return "".join(self.iter_json())
+
+    def iter_json(self, ndjson=False, batch_size=100):
+        """
+        Export pages and their revisions as a stream of text chunks,
+        either one JSON array or one JSON page per line (NDJSON).
+        Pages are read in batches and revisions through a server side
+        cursor on a connection of its own, so memory use stays flat
+        and the export can outlive the request's transaction.
+        """
+        pages = ArticlePage.__table__
+        revisions = ArticleRevision.__table__
+        page_columns = [c for c in pages.c if c.name not in EXPORT_EXCLUDE]
         dthandler = (lambda obj: obj.isoformat() 
                      if isinstance(obj, datetime.datetime) else None)
-        return json.dumps(result, default=dthandler)
-    
+        dumps = lambda obj: json.dumps(obj, default=dthandler)
+        separator = "\n" if ndjson else ", "
+        connection = DBSession.get_bind().connect()
+        try:
+            if not ndjson:
+                yield "["
+            last_id = 0
+            first = True
+            while True:
+                page_rows = connection.execute(
+                    select(*page_columns).where(pages.c.id > last_id
+                    ).order_by(pages.c.id).limit(batch_size)).fetchall()
+                if not page_rows:
+                    break
+                last_id = page_rows[-1].id
+                result = connection.execution_options(stream_results=True
+                    ).execute(select(revisions).where(
+                        revisions.c.page_id.in_([r.id for r in page_rows])
+                    ).order_by(revisions.c.page_id, revisions.c.created,
+                               revisions.c.id))
+                revision_rows = iter(result)
+                pending = next(revision_rows, None)
+                for page_row in page_rows:
+                    if not first:
+                        yield separator
+                    first = False
+                    # Write the page without its closing brace, then
+                    # stream its revisions into it.
+                    yield dumps(dict(page_row._mapping))[:-1]
+                    yield ', "revisions": ['
+                    count = 0
+                    snapshots = {}
+                    while (pending is not None and
+                           pending.page_id == page_row.id):
+                        if count:
+                            yield ", "
+                        yield dumps(self.export_revision(pending, snapshots))
+                        count += 1
+                        pending = next(revision_rows, None)
+                    yield "]}"
+                result.close()
+            yield "\n" if ndjson else "]"
+        finally:
+            connection.close()
+
+    def export_revision(self, row, snapshots):
+        """
+        Turn a revision row into a dict with its full text. snapshots
+        holds the text of the last snapshot seen, which is normally the
+        base of the deltas after it.
+        """
+        def load_base():
+            if row.base_id in snapshots:
+                return snapshots[row.base_id]
+            return DBSession.query(ArticleRevision).filter_by(
+                                                id=row.base_id).one().article
+        text = unpack(row.storage, row.article, row.data, load_base)
+        if row.storage in SNAPSHOTS:
+            snapshots.clear()
+            snapshots[row.id] = text
+        result = dict((k, v) for k, v in row._mapping.items()
+                      if k not in EXPORT_EXCLUDE)
+        result["article"] = text
+        return result
+
     def from_json(self, request, data):
-        u = UserLib()
-        data = json.loads(data)
-        def convert_date(date):
-            if isinstance(date, str):
-                date = date.split(".")[0]
-            date_format = "%Y-%m-%dT%H:%M:%S"
-            try:
-                return datetime.datetime.strptime(date, date_format)
-            except TypeError:
-                return datetime.datetime(1900, 1, 1)
-            except ValueError:
-                return datetime.datetime(1900, 1, 1)
-        # Convert the dates back
-        for k, dummy in enumerate(data):
-            data[k]['created'] = convert_date(data[k]['created'])
-            for k2, dummy in enumerate(data[k]['revisions']):
-                data[k]['revisions'][k2]['created'] = \
-                            convert_date(data[k]['revisions'][k2]['created'])
-        # Delete all articles
-        for page in DBSession.query(ArticlePage):
-            DBSession.delete(page)
+        self.restore(request, io.StringIO(data))
+
+    def restore(self, request, fp, batch_size=100, resume=False,
+                progress=None, commit=None):
+        """
+        Restore pages from a backup made by iter_json, read from a file
+        object a page at a time. Pages and revisions are bulk inserted
+        batch_size pages at a time and only the latest revision of each
+        public page is indexed.
+        All pages are deleted first, unless resume is set, in which case
+        pages that already exist are skipped. progress is called with the
+        number of pages and revisions restored after each batch, commit
+        is called after each batch so an interrupted restore can be
+        resumed.
+        """
+        if not resume:
+            self.delete_all(request)
+            if commit:
+                commit()
+        pages = 0
+        revisions = 0
+        batch = []
+        for row in iter_backup(fp):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                page_count, revision_count = self.restore_batch(
+                                                request, batch, resume)
+                pages += page_count
+                revisions += revision_count
+                batch = []
+                if commit:
+                    commit()
+                if progress:
+                    progress(pages, revisions)
+        if batch:
+            page_count, revision_count = self.restore_batch(request, batch,
+                                                            resume)
+            pages += page_count
+            revisions += revision_count
+            if commit:
+                commit()
+            if progress:
+                progress(pages, revisions)
+        return pages, revisions
+
+    def delete_all(self, request):
+        """
+        Delete all pages with bulk deletes.
+        """
+        self.forget_page(request)
+        for name, in DBSession.query(ArticlePage.name):
             self.s.delete_from_index(request.route_url("article_read", 
-                                                page_id=page.name))
-        # Add articles back again
-        for row in data:
-            # Delete revisions and store in memory for later use
-            revisions = row['revisions']
-            del(row['revisions'])
-            # Create page
-            page = ArticlePage()
-            for k, v in row.items():
-                try:
-                    setattr(page, k, v)
-                except:
-                    pass
-            if not page.user_id:
-                page.user_id = 1
-            DBSession.add(page)
-            page = self.show_page(row['name'])
-
-            user = None
-            # Add revisions
-            for row2 in revisions:
-                revision = ArticleRevision()
-                for k, v in row2.items():
-                    try:
-                        setattr(revision, k, v)
-                    except:
-                        pass
-                page.revisions.append(revision)
-                user = u.show_by_id(revision.user_id)
-                self.update_article_index(request, page, revision, user.name)
-            if user:
-                page = self.add_addons(page, row['name'],
-                                       row['display_name'], user)
\ No newline at end of file
+                                                       page_id=name))
+        execute(ArticlePage.__table__.update().values(
+                                                current_revision_id=None))
+        for table in (ArticleIndexQueue.__table__,
+                      ArticleVotes.__table__, ArticleTagCount.__table__,
+                      ArticleTags.__table__,
+                      ArticleRevision.__table__, ArticlePage.__table__):
+            execute(table.delete())
+        render_cache.clear(shared=True)
+        text_cache.clear()
+        diff_cache.clear()
+        page_cache.clear()
+
+    def restore_batch(self, request, rows, resume=False):
+        """
+        Bulk insert a batch of pages with their revisions.
+        Returns the number of pages and revisions inserted.
+        """
+        pages = ArticlePage.__table__
+        revisions = ArticleRevision.__table__
+        if resume:
+            existing = set(name for name, in DBSession.query(
+                ArticlePage.name).filter(
+                ArticlePage.name.in_([row['name'] for row in rows])))
+            rows = [row for row in rows if row['name'] not in existing]
+        if not rows:
+            return 0, 0
+        page_rows = []
+        for row in rows:
+            page_row = dict((k, v) for k, v in row.items()
+                            if k in pages.c and k not in EXPORT_EXCLUDE)
+            page_row['created'] = convert_date(row.get('created'))
+            page_row['name_lower'] = row['name'].lower()
+            if not page_row.get('user_id'):
+                page_row['user_id'] = 1
+            page_rows.append(page_row)
+        execute(pages.insert(), fill_missing(page_rows))
+        page_ids = dict(DBSession.query(ArticlePage.name, ArticlePage.id
+                ).filter(ArticlePage.name.in_([row['name'] for row in rows])))
+        revision_rows = []
+        for row in rows:
+            for revision in row.get('revisions', []):
+                revision_row = dict((k, v) for k, v in revision.items()
+                                    if k in revisions.c and
+                                    k not in EXPORT_EXCLUDE)
+                revision_row['page_id'] = page_ids[row['name']]
+                revision_row['created'] = convert_date(revision.get('created'))
+                if not revision_row.get('user_id'):
+                    revision_row['user_id'] = 1
+                revision_rows.append(revision_row)
+        if revision_rows:
+            execute(revisions.insert(), fill_missing(revision_rows))
+        self.index_pages(request, list(page_ids.values()))
+        if s.has_setting("PYRACMS_FORUM") or s.has_setting("PYRACMS_GALLERY"):
+            u = UserLib()
+            for page in DBSession.query(ArticlePage).filter(
+                                ArticlePage.id.in_(list(page_ids.values()))):
+                revision = page.revisions.order_by(None).order_by(
+                    ArticleRevision.created).first()
+                if revision:
+                    self.add_addons(page, page.name, page.display_name,
+                                    u.show_by_id(revision.user_id))
+        return len(page_rows), len(revision_rows)
+
+    def index_pages(self, request, page_ids):
+        """
+        Store html for and index the latest revision of each public page,
+        in a fixed number of queries.
+        """
+        if not page_ids:
+            return
+        latest = DBSession.query(ArticleRevision.page_id,
+            func.max(ArticleRevision.created).label("created")
+            ).filter(ArticleRevision.page_id.in_(page_ids)
+            ).group_by(ArticleRevision.page_id).subquery()
+        query = DBSession.query(ArticlePage, ArticleRevision, User.name).join(
+            ArticleRevision, ArticleRevision.page_id == ArticlePage.id).join(
+            latest, and_(latest.c.page_id == ArticleRevision.page_id,
+                         latest.c.created == ArticleRevision.created)).join(
+            User, ArticleRevision.user_id == User.id).options(
+            joinedload(ArticlePage.renderer)).order_by(
+            ArticlePage.id, desc(ArticleRevision.id))
+        # Backups keep whole seconds, so revisions saved in the same
+        # second tie on created and the newest id wins
+        seen = set()
+        for page, revision, username in query:
+            if page.id in seen:
+                continue
+            seen.add(page.id)
+            page.current_revision = revision
+            self.prerender(page, revision)
+            if not page.private:
+                self.index_page(request, page, revision, username)
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from threading import RLock
+import uuid
+
+_missing = object()
+
+def shared_backend_from_settings(settings, prefix):
+    """
+    Build a dogpile.cache region from settings starting with prefix,
+    for example "article_render_cache.backend = dogpile.cache.redis".
+    Return None if no backend is configured.
+    """
+    if not settings.get(prefix + "backend"):
+        return None
+    from dogpile.cache import make_region
+    return make_region().configure_from_config(settings, prefix)
+
+class LRUCache():
+    """
+    A thread safe in process cache with least recently used eviction
+    and an optional shared backend (a dogpile.cache region). Shared keys
+    are prefixed with a generation kept in the backend, so clearing the
+    shared backend only needs a new generation. on_evict is called with
+    each key evicted to make room.
+    """
+
+    GENERATION_KEY = "__generation__"
+
+    def __init__(self, max_size=1024, backend=None, on_evict=None):
+        self.max_size = max_size
+        self.backend = backend
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+        self._generation = ""
+
+    def configure(self, max_size=None, backend=None):
+        """
+        Change size or backend, clearing the in process cache.
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            self.backend = backend
+            self._data.clear()
+
+    def _shared_generation(self):
+        """
+        Get the shared backend's generation, clearing the in process
+        cache if another process has started a new one.
+        """
+        from dogpile.cache.api import NO_VALUE
+        generation = self.backend.get(self.GENERATION_KEY)
+        if generation is NO_VALUE:
+            generation = ""
+        with self._lock:
+            if generation != self._generation:
+                self._data.clear()
+                self._generation = generation
+        return generation
+
+    def _shared_key(self, key, generation):
+        key = ":".join([str(x) for x in key]) if isinstance(key, tuple) \
+            else str(key)
+        return "%s:%s" % (generation, key) if generation else key
+
+    def get(self, key, default=None):
+        """
+        Get a value, checking the shared backend on a local miss.
+        """
+        with self._lock:
+            value = self._data.get(key, _missing)
+            if value is not _missing:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.backend is not None:
+            from dogpile.cache.api import NO_VALUE
+            value = self.backend.get(self._shared_key(
+                                        key, self._shared_generation()))
+            if value is not NO_VALUE:
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def _store(self, key, value):
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                evicted.append(self._data.popitem(last=False)[0])
+        if self.on_evict is not None:
+            for old_key in evicted:
+                self.on_evict(old_key)
+
+    def set(self, key, value):
+        if self.backend is not None:
+            self.backend.set(self._shared_key(
+                                key, self._shared_generation()), value)
+        self._store(key, value)
+
+    def get_or_create(self, key, creator):
+        """
+        Get a value, calling creator to make it on a miss.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = creator()
+            self.set(key, value)
+        return value
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+        if self.backend is not None and keys:
+            generation = self._shared_generation()
+            self.backend.delete_multi([self._shared_key(key, generation)
+                                       for key in keys])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_if(self, predicate):
+        """
+        Delete in process entries whose key matches predicate. The shared
+        backend can't be searched, so it is left alone.
+        """
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self, shared=False):
+        """
+        Clear the in process cache. With shared, also start a new
+        generation of the shared backend, so no process sees what was
+        stored in it before.
+        """
+        with self._lock:
+            self._data.clear()
+        if shared and self.backend is not None:
+            generation = uuid.uuid4().hex
+            self.backend.set(self.GENERATION_KEY, generation)
+            with self._lock:
+                self._generation = generation
+
+    def stats(self):
+        """
+        Get hit and miss counters.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._data), "max_size": self.max_size,
+                    "hit_ratio": float(self.hits) / total if total else 0.0,
+                    "shared_backend": self.backend is not None}
+
+# Rendered articles keyed by (revision id, renderer name)
+render_cache = LRUCache()
+# Revision text rebuilt from deltas keyed by revision id
+text_cache = LRUCache(256)
+# Revision diffs keyed by (old revision id, new revision id)
+diff_cache = LRUCache(128)
+
+def configure_caches(settings):
+    """
+    Configure module level caches from application settings.
+    """
+    render_cache.configure(
+        int(settings.get("article_render_cache_size", 1024)),
+        shared_backend_from_settings(settings, "article_render_cache."))
+    text_cache.configure(
+        int(settings.get("article_revision_cache_size", 256)))
+    diff_cache.configure(
+        int(settings.get("article_diff_cache_size", 128)))
@@ -0,0 +1,235 @@
+"""
+Opt in request instrumentation.
+
+A tween starts a collector for each request. ArticleLib methods and
+views time themselves with phase(), and SQLAlchemy cursor events count
+queries, both only when a collector is active in the thread. Totals are
+kept per route and written in the Prometheus text format.
+"""
+from contextlib import contextmanager
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Lock, local
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_local = local()
+
+class Collector():
+    """
+    Phase timings and queries for one request.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.active = set()
+        self.queries = []
+        self.template_start = None
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @property
+    def query_seconds(self):
+        return sum([seconds for statement, seconds in self.queries])
+
+def current():
+    """
+    Get the collector for this thread's request, or None.
+    """
+    return getattr(_local, "collector", None)
+
+@contextmanager
+def phase(name):
+    """
+    Time a block as a phase of the current request. Nested blocks with
+    the same name are only counted once.
+    """
+    collector = current()
+    if collector is None or name in collector.active:
+        yield
+        return
+    collector.active.add(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        collector.active.discard(name)
+        collector.add_phase(name, time.time() - start)
+
+def timed(name):
+    """
+    Decorate a function to time it as a phase.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if current() is None:
+                return func(*args, **kwargs)
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current() is not None:
+        conn.info.setdefault("article_query_start", []).append(time.time())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    collector = current()
+    starts = conn.info.get("article_query_start")
+    if collector is not None and starts:
+        collector.queries.append((statement, time.time() - starts.pop()))
+
+def before_render(event):
+    """
+    Mark the start of template rendering, which includes the menus.
+    """
+    collector = current()
+    if collector is not None and collector.template_start is None:
+        collector.template_start = time.time()
+
+class Metrics():
+    """
+    Request, phase and query totals per route.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.routes = {}
+
+    def record(self, route, seconds, collector):
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    "count": 0, "seconds": 0.0, "queries": 0,
+                    "query_seconds": 0.0, "phases": {},
+                    "buckets": [0] * len(BUCKETS)}
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["queries"] += len(collector.queries)
+            stats["query_seconds"] += collector.query_seconds
+            for name, value in collector.phases.items():
+                stats["phases"][name] = stats["phases"].get(name, 0.0) + value
+            for i, bucket in enumerate(BUCKETS):
+                if seconds <= bucket:
+                    stats["buckets"][i] += 1
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+
+    def prometheus(self, gauges=()):
+        """
+        Write totals, and extra (name, labels, value) gauges, in the
+        Prometheus text format.
+        """
+        with self.lock:
+            routes = sorted([(route, dict(stats, phases=dict(stats["phases"]),
+                                          buckets=list(stats["buckets"])))
+                             for route, stats in self.routes.items()])
+        lines = ["# TYPE article_request_seconds histogram"]
+        for route, stats in routes:
+            label = 'route="%s"' % route
+            for bucket, count in zip(BUCKETS, stats["buckets"]):
+                lines.append('article_request_seconds_bucket{%s,le="%s"} %d'
+                             % (label, bucket, count))
+            lines.append('article_request_seconds_bucket{%s,le="+Inf"} %d'
+                         % (label, stats["count"]))
+            lines.append("article_request_seconds_sum{%s} %f" %
+                         (label, stats["seconds"]))
+            lines.append("article_request_seconds_count{%s} %d" %
+                         (label, stats["count"]))
+        for name, key in (("article_request_queries_total", "queries"),
+                          ("article_request_query_seconds_total",
+                           "query_seconds")):
+            lines.append("# TYPE %s counter" % name)
+            for route, stats in routes:
+                lines.append('%s{route="%s"} %s' % (name, route, stats[key]))
+        lines.append("# TYPE article_request_phase_seconds_total counter")
+        for route, stats in routes:
+            for name, value in sorted(stats["phases"].items()):
+                lines.append('article_request_phase_seconds_total'
+                             '{route="%s",phase="%s"} %f' %
+                             (route, name, value))
+        last = None
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            if name != last:
+                lines.append("# TYPE %s gauge" % name)
+                last = name
+            label = ",".join(['%s="%s"' % item
+                              for item in sorted(labels.items())])
+            lines.append("%s{%s} %s" % (name, label, value) if label
+                         else "%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+_listening = []
+
+def listen():
+    """
+    Count queries on every engine. Safe to call more than once.
+    """
+    if _listening:
+        return
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    _listening.append(True)
+
+@contextmanager
+def collecting():
+    """
+    Collect phases and queries in this thread for the duration of a
+    block, yielding the collector.
+    """
+    collector = _local.collector = Collector()
+    try:
+        yield collector
+    finally:
+        _local.collector = None
+        if collector.template_start is not None:
+            collector.add_phase("template",
+                                time.time() - collector.template_start)
+
+def log_slow_request(request, route, seconds, collector):
+    queries = sorted(collector.queries, key=lambda query: -query[1])
+    log.warning("Slow request %s %s (%s) %.3fs, phases: %s, "
+                "%d queries in %.3fs, slowest:\n%s",
+                request.method, request.path, route, seconds,
+                ", ".join(["%s %.3fs" % item
+                           for item in sorted(collector.phases.items())]),
+                len(collector.queries), collector.query_seconds,
+                "\n".join(["  %.3fs %s" % (query_seconds, " ".join(
+                                                statement.split())[:500])
+                           for statement, query_seconds in queries[:10]]))
+
+def instrument_tween_factory(handler, registry):
+    """
+    Collect timings and queries for each request. Requests slower than
+    article_slow_request_ms are logged with their slowest queries.
+    """
+    slow = float(registry.settings.get("article_slow_request_ms", 0)) / 1000
+    listen()
+
+    def instrument_tween(request):
+        try:
+            with collecting() as collector:
+                return handler(request)
+        finally:
+            seconds = time.time() - collector.start
+            route = getattr(request.matched_route, "name", None)
+            if route is not None:
+                metrics.record(route, seconds, collector)
+                if slow and seconds >= slow:
+                    log_slow_request(request, route, seconds, collector)
+    return instrument_tween
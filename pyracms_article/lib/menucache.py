@@ -0,0 +1,77 @@
+from .cachelib import LRUCache
+from pyracms.lib.widgetlib import WidgetLib
+from pyramid.security import effective_principals, has_permission
+from urllib.parse import quote
+import time
+
+def check_permission(permission, context, request):
+    """
+    has_permission, remembered for the rest of the request.
+    """
+    memo = getattr(request, "article_permissions", None)
+    if memo is None:
+        memo = request.article_permissions = {}
+    key = (permission, id(context))
+    if key not in memo:
+        memo[key] = bool(has_permission(permission, context, request))
+    return memo[key]
+
+def request_principals(request):
+    """
+    Effective principals, remembered for the rest of the request.
+    """
+    principals = getattr(request, "article_principals", None)
+    if principals is None:
+        principals = request.article_principals = tuple(sorted(
+                    [str(principal)
+                     for principal in effective_principals(request)]))
+    return principals
+
+def marker(name):
+    return "__article_menu_%s__" % name
+
+class MenuCache():
+    """
+    Cache generated menus by group, host and principals. Menus are made
+    once with a marker in place of each parameter, and the markers are
+    replaced with the page's values when the menu is shown, so the
+    permission of every item is only checked on a miss.
+    """
+
+    def __init__(self, ttl=60, max_size=256):
+        self.ttl = ttl
+        self.cache = LRUCache(max_size)
+
+    def configure(self, ttl, max_size=None):
+        self.ttl = ttl
+        self.cache.configure(max_size)
+
+    def generate(self, group, context, request, params):
+        """
+        Get menu items like WidgetLib.generate_menu.
+        """
+        if not self.ttl:
+            return WidgetLib().generate_menu(group, context, request, params)
+        key = (group, request.host_url, request_principals(request),
+               tuple(sorted(params)))
+        entry = self.cache.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            items = WidgetLib().generate_menu(
+                    group, context, request,
+                    dict([(name, marker(name)) for name in params]))
+            entry = (time.time(), [tuple(item) for item in items])
+            self.cache.set(key, entry)
+        return [self.fill(item, params) for item in entry[1]]
+
+    def fill(self, item, params):
+        url, label = item[0], item[1]
+        for name, value in params.items():
+            value = "" if value is None else str(value)
+            url = url.replace(marker(name), quote(value, safe=""))
+            label = label.replace(marker(name), value)
+        return (url, label) + item[2:]
+
+    def clear(self):
+        self.cache.clear()
+
+menu_cache = MenuCache()
@@ -0,0 +1,208 @@
+from .cachelib import LRUCache
+from threading import Lock, Thread
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import time
+import transaction
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+# Most surrogate keys sent to the fronting cache in one PURGE
+PURGE_BATCH = 100
+
+def surrogate_keys(name, revision_id=None):
+    """
+    Get the Surrogate-Key header value for an article page.
+    """
+    keys = ["article", "article-%s" % name]
+    if revision_id:
+        keys.append("article-%s-%s" % (name, revision_id))
+    return " ".join(keys)
+
+class MemoryPageStore():
+    """
+    Keep pages in an in process LRU cache for up to ttl seconds. Other
+    processes aren't told about purges, so with several workers a page
+    can be stale for up to ttl seconds after a change.
+    """
+
+    def __init__(self, max_size, ttl=60):
+        self.cache = LRUCache(max_size, on_evict=self.forget)
+        self.ttl = ttl
+        self.known = {}
+        self.lock = Lock()
+
+    def get(self, name, version):
+        entry = self.cache.get((name, version))
+        if entry is None or (self.ttl and time.time() - entry[0] > self.ttl):
+            return None
+        return entry[1]
+
+    def set(self, name, version, body):
+        with self.lock:
+            self.known.setdefault(name, set()).add(version)
+        self.cache.set((name, version), (time.time(), body))
+
+    def forget(self, key):
+        """
+        Stop tracking a page version evicted from the cache.
+        """
+        name, version = key
+        with self.lock:
+            versions = self.known.get(name)
+            if versions is not None:
+                versions.discard(version)
+                if not versions:
+                    del self.known[name]
+
+    def purge(self, name):
+        with self.lock:
+            versions = self.known.pop(name, set())
+        self.cache.delete_multi([(name, version) for version in versions])
+
+    def clear(self):
+        with self.lock:
+            self.known.clear()
+        self.cache.clear()
+
+class DiskPageStore():
+    """
+    Keep pages as files, one directory per page.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def page_path(self, name):
+        return os.path.join(self.path,
+                            hashlib.sha1(name.encode("utf-8")).hexdigest())
+
+    def get(self, name, version):
+        try:
+            with open(os.path.join(self.page_path(name),
+                                   version), "rb") as fp:
+                return fp.read().decode("utf-8")
+        except (IOError, OSError):
+            return None
+
+    def set(self, name, version, body):
+        path = self.page_path(name)
+        try:
+            os.makedirs(path, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=path)
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(body.encode("utf-8"))
+            os.replace(temp_path, os.path.join(path, version))
+        except FileNotFoundError:
+            # The page was purged while it was written, so it's stale
+            pass
+
+    def purge(self, name):
+        shutil.rmtree(self.page_path(name), ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class PageCache():
+    """
+    An opt in cache of fully rendered article pages for anonymous users,
+    configured with article_page_cache = memory or disk. Pages hold
+    absolute urls, so they are kept per host url.
+    """
+
+    def __init__(self):
+        self.store = None
+        self.purge_url = None
+        self.purge_queue = queue.Queue()
+        self.purge_thread = None
+        self.lock = Lock()
+
+    def configure(self, settings):
+        kind = settings.get("article_page_cache")
+        if kind == "memory":
+            self.store = MemoryPageStore(
+                int(settings.get("article_page_cache_size", 1024)),
+                int(settings.get("article_page_cache_ttl", 60)))
+        elif kind == "disk":
+            self.store = DiskPageStore(settings["article_page_cache_path"])
+        else:
+            self.store = None
+        self.purge_url = settings.get("article_page_cache_purge_url")
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def version(self, revision_id, host_url):
+        return "%s-%s" % (revision_id or "current", hashlib.sha1(
+                                host_url.encode("utf-8")).hexdigest()[:16])
+
+    def get(self, name, revision_id, host_url):
+        if self.store is None:
+            return None
+        return self.store.get(name, self.version(revision_id, host_url))
+
+    def set(self, name, revision_id, host_url, body):
+        if self.store is not None:
+            self.store.set(name, self.version(revision_id, host_url), body)
+
+    def purge(self, name):
+        """
+        Purge a page now and again once the transaction commits, so a
+        request that read the old page in between can't leave it cached.
+        A fronting cache is sent the page's surrogate key from a
+        background thread, together with any other keys waiting.
+        """
+        if self.store is None and not self.purge_url:
+            return
+        if self.store is not None:
+            self.store.purge(name)
+        transaction.get().addAfterCommitHook(self._purge, (name,))
+
+    def clear(self):
+        if self.store is not None:
+            self.store.clear()
+
+    def _purge(self, success, name):
+        if not success:
+            return
+        if self.store is not None:
+            self.store.purge(name)
+        if self.purge_url:
+            self.purge_queue.put(name)
+            with self.lock:
+                if self.purge_thread is None or \
+                        not self.purge_thread.is_alive():
+                    self.purge_thread = Thread(target=self._purge_upstream,
+                                               name="article-page-purge",
+                                               daemon=True)
+                    self.purge_thread.start()
+
+    def _purge_upstream(self):
+        """
+        Send queued purges to the fronting cache from one thread, up to
+        PURGE_BATCH surrogate keys per PURGE.
+        """
+        while True:
+            names = [self.purge_queue.get()]
+            while len(names) < PURGE_BATCH:
+                try:
+                    names.append(self.purge_queue.get_nowait())
+                except queue.Empty:
+                    break
+            request = urllib.request.Request(
+                self.purge_url, method="PURGE",
+                headers={"Surrogate-Key": " ".join(sorted(set(
+                            ["article-%s" % name for name in names])))})
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except Exception:
+                log.exception("Purging %s pages from the fronting cache "
+                              "failed", len(names))
+
+page_cache = PageCache()
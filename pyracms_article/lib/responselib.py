@@ -0,0 +1,43 @@
+from pyramid.security import authenticated_userid
+import hashlib
+
+def article_etag(page, revision, *extra):
+    """
+    Make an entity tag from everything that shows up on an article page.
+    A revision never changes, so its id stands in for the text.
+    """
+    state = [revision.id, page.renderer_id, page.display_name,
+             page.hide_display_name, page.private, page.up_count,
+             page.down_count] + list(extra)
+    return hashlib.sha1("|".join([str(x) for x in state]
+                                 ).encode("utf-8")).hexdigest()
+
+def conditional_response(request, page, revision, immutable=False, *extra):
+    """
+    Put validators and cache headers on request.response.
+    Returns request.response turned into a 304 Not Modified if the
+    request's entity tag matches, otherwise None.
+    Votes, titles and privacy have no modification time, so the entity
+    tag is the only validator. Browsers keep responses for
+    article_max_age (a minute by default); immutable responses may be
+    kept by shared caches, which are purged by surrogate key, for
+    article_revision_max_age (a year by default).
+    """
+    settings = request.registry.settings
+    response = request.response
+    userid = authenticated_userid(request)
+    etag = article_etag(page, revision, userid, *extra)
+    response.etag = (etag, False)
+    response.cache_control.max_age = int(settings.get("article_max_age", 60))
+    if userid:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+        if immutable:
+            response.cache_control.s_maxage = int(settings.get(
+                                    "article_revision_max_age", 31536000))
+    response.vary = ("Cookie",)
+    if request.if_none_match and etag in request.if_none_match:
+        response.status_int = 304
+        return response
+    return None
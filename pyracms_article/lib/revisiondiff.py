@@ -0,0 +1,109 @@
+from difflib import SequenceMatcher
+import re
+
+WORDS = re.compile(r"\s+|\w+|[^\w\s]")
+# Replaced blocks bigger than this are not diffed by word
+WORD_DIFF_MAX_CHARS = 20000
+
+def word_diff(a_lines, b_lines):
+    """
+    Diff replaced lines word by word, as (op, text) pairs where op is
+    equal, delete or insert.
+    """
+    a_words = WORDS.findall("".join(a_lines))
+    b_words = WORDS.findall("".join(b_lines))
+    result = []
+    matcher = SequenceMatcher(None, a_words, b_words, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            result.append(("equal", "".join(a_words[i1:i2])))
+            continue
+        if i2 > i1:
+            result.append(("delete", "".join(a_words[i1:i2])))
+        if j2 > j1:
+            result.append(("insert", "".join(b_words[j1:j2])))
+    return result
+
+def linear_opcodes(a_lines, b_lines):
+    """
+    Opcodes in linear time for texts too big to diff properly: common
+    leading and trailing lines are kept, the rest is one replacement.
+    """
+    start = 0
+    limit = min(len(a_lines), len(b_lines))
+    while start < limit and a_lines[start] == b_lines[start]:
+        start += 1
+    end = 0
+    while (end < limit - start and
+           a_lines[len(a_lines) - end - 1] == b_lines[len(b_lines) - end - 1]):
+        end += 1
+    opcodes = []
+    if start:
+        opcodes.append(("equal", 0, start, 0, start))
+    a_end = len(a_lines) - end
+    b_end = len(b_lines) - end
+    if a_end > start and b_end > start:
+        opcodes.append(("replace", start, a_end, start, b_end))
+    elif a_end > start:
+        opcodes.append(("delete", start, a_end, start, start))
+    elif b_end > start:
+        opcodes.append(("insert", start, start, start, b_end))
+    if end:
+        opcodes.append(("equal", a_end, len(a_lines), b_end, len(b_lines)))
+    return opcodes
+
+def group_opcodes(opcodes, context):
+    """
+    Split opcodes into hunks with context lines of equal text around
+    each change, like difflib's unified diffs.
+    """
+    hunks = []
+    hunk = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            if hunk and i2 - i1 > context * 2:
+                hunk.append((tag, i1, i1 + context, j1, j1 + context))
+                hunks.append(hunk)
+                hunk = []
+                i1, j1 = i2 - context, j2 - context
+            elif not hunk:
+                i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        if tag != "equal" or hunk or i2 > i1:
+            hunk.append((tag, i1, i2, j1, j2))
+    if hunk and any(op[0] != "equal" for op in hunk):
+        hunks.append(hunk)
+    return hunks
+
+def diff_texts(a, b, context=3, max_lines=2000):
+    """
+    Diff two texts by line, with replaced lines also diffed by word.
+    Texts with more than max_lines lines get a linear time diff and no
+    word diff, so a huge article can't tie up a worker. Big replaced
+    blocks are not diffed by word for the same reason.
+    Returns a dict with a list of hunks, each with line ranges and
+    lines as (op, text) pairs where op is " ", "-" or "+".
+    """
+    a_lines = a.splitlines(True)
+    b_lines = b.splitlines(True)
+    fast = len(a_lines) > max_lines or len(b_lines) > max_lines
+    if fast:
+        opcodes = linear_opcodes(a_lines, b_lines)
+    else:
+        opcodes = SequenceMatcher(None, a_lines, b_lines).get_opcodes()
+    hunks = []
+    for group in group_opcodes(opcodes, context):
+        lines = []
+        words = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                lines.extend([(" ", line) for line in a_lines[i1:i2]])
+                continue
+            lines.extend([("-", line) for line in a_lines[i1:i2]])
+            lines.extend([("+", line) for line in b_lines[j1:j2]])
+            size = sum(map(len, a_lines[i1:i2] + b_lines[j1:j2]))
+            if tag == "replace" and size <= WORD_DIFF_MAX_CHARS and not fast:
+                words.append(word_diff(a_lines[i1:i2], b_lines[j1:j2]))
+        hunks.append({"a_start": group[0][1], "a_end": group[-1][2],
+                      "b_start": group[0][3], "b_end": group[-1][4],
+                      "lines": lines, "words": words})
+    return {"hunks": hunks, "fast": fast}
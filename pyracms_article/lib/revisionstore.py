@@ -0,0 +1,79 @@
+"""
+Revision text storage.
+
+A revision is stored either as a snapshot of its full text, or as a
+line based delta against the snapshot before it. Either may be zlib
+compressed. Deltas are always against a snapshot, never another delta,
+so any revision can be rebuilt from at most two rows.
+"""
+from .cachelib import text_cache # @UnusedImport
+from difflib import SequenceMatcher
+import json
+import zlib
+
+FULL = 0
+FULL_ZLIB = 1
+DELTA = 2
+DELTA_ZLIB = 3
+
+SNAPSHOTS = (FULL, FULL_ZLIB)
+
+def make_delta(base, text):
+    """
+    Make a delta that turns base into text. Each item is either a
+    [start, end] range of base lines to copy or a string to insert.
+    """
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    delta = []
+    matcher = SequenceMatcher(None, base_lines, lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif tag in ("replace", "insert"):
+            delta.append("".join(lines[j1:j2]))
+    return json.dumps(delta, separators=(",", ":"))
+
+def apply_delta(base, delta):
+    """
+    Rebuild text from base and a delta made by make_delta.
+    """
+    base_lines = base.splitlines(True)
+    return "".join(["".join(base_lines[item[0]:item[1]])
+                    if isinstance(item, list) else item
+                    for item in json.loads(delta)])
+
+def pack(text, base=None, compress=True):
+    """
+    Encode text for storage, as a delta against base text if given and
+    smaller. Returns storage, article and data column values.
+    """
+    storage = FULL
+    value = text
+    if base is not None:
+        delta = make_delta(base, text)
+        if len(delta) < len(text):
+            storage = DELTA
+            value = delta
+    if compress:
+        data = zlib.compress(value.encode("utf-8"))
+        if len(data) < len(value.encode("utf-8")):
+            return storage + 1, None, data
+    if storage == FULL:
+        return FULL, text, None
+    return DELTA, None, value.encode("utf-8")
+
+def unpack(storage, article, data, load_base=None):
+    """
+    Decode stored text. load_base is called to get the base snapshot's
+    text for deltas.
+    """
+    if storage == FULL:
+        return article
+    if storage in (FULL_ZLIB, DELTA_ZLIB):
+        value = zlib.decompress(data).decode("utf-8")
+    else:
+        value = data.decode("utf-8")
+    if storage == FULL_ZLIB:
+        return value
+    return apply_delta(load_base(), value)
@@ -0,0 +1,94 @@
+from ..models import ArticlePage
+from pyracms.models import DBSession
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.functions import func
+from threading import Event, Lock, Thread
+import atexit
+import logging
+
+log = logging.getLogger(__name__)
+
+class ViewCounter():
+    """
+    Count page views in memory and write them to the database in one
+    batched update every interval seconds or threshold views, whichever
+    comes first, instead of updating a row on every view. Writes are
+    made by a background thread, started on the first view in each
+    process, so requests never wait on them.
+    """
+
+    def __init__(self, interval=60, threshold=1000):
+        self.interval = interval
+        self.threshold = threshold
+        self.pending = {}
+        self.total = 0
+        self.lock = Lock()
+        self.wake = Event()
+        self.thread = None
+
+    def configure(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+
+    def incr(self, page_id, count=1):
+        """
+        Count a view of a page.
+        """
+        with self.lock:
+            self.pending[page_id] = self.pending.get(page_id, 0) + count
+            self.total += count
+            due = self.total >= self.threshold
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run,
+                                     name="article-view-counter", daemon=True)
+                self.thread.start()
+        if due:
+            self.wake.set()
+
+    def run(self):
+        """
+        Flush every interval seconds, or sooner when woken by incr.
+        """
+        while True:
+            self.wake.wait(max(self.interval, 1))
+            self.wake.clear()
+            self.flush()
+
+    def pending_count(self, page_id):
+        """
+        Get views of a page not yet written to the database.
+        """
+        with self.lock:
+            return self.pending.get(page_id, 0)
+
+    def flush(self):
+        """
+        Write pending views in one statement on a connection of its own,
+        so it doesn't take part in a request's transaction.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.total = 0
+        if not pending:
+            return
+        table = ArticlePage.__table__
+        statement = table.update().where(
+            table.c.id == bindparam("page_id")).values(
+            view_count=func.coalesce(table.c.view_count, 0) +
+                       bindparam("views"))
+        try:
+            with DBSession.get_bind().begin() as connection:
+                connection.execute(statement,
+                                   [{"page_id": page_id, "views": views}
+                                    for page_id, views in pending.items()])
+        except Exception:
+            log.exception("Writing view counts failed")
+            with self.lock:
+                for page_id, views in pending.items():
+                    self.pending[page_id] = (self.pending.get(page_id, 0) +
+                                             views)
+                    self.total += views
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
@@ -1,13 +1,17 @@
+from .lib import revisionstore
 from datetime import datetime
 from pyracms.models import Base, JsonBase, User
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Column, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import object_session, relationship, synonym, validates
+from sqlalchemy.schema import Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.sql.expression import desc
-from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime, Boolean
+from sqlalchemy.types import (Integer, Unicode, UnicodeText, DateTime, Boolean,
+                              LargeBinary)
 
 class ArticleTags(Base):
     __tablename__ = 'articletags'
-    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_articletags_name_page_id', 'name', 'page_id'),
+                      Index('ix_articletags_page_id_name', 'page_id', 'name'),
+                      {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'})
 
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(128), index=True, nullable=False)
@@ -17,19 +21,42 @@ class ArticleTags(Base):
     def __init__(self, name):
         self.name = name
 
+class ArticleTagCount(Base):
+    """
+    Number of public pages with each tag, kept up to date as tags and
+    pages change.
+    """
+    __tablename__ = 'articletagcount'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode(128), index=True, unique=True, nullable=False)
+    count = Column(Integer, default=0, nullable=False, index=True)
+
 class ArticleRevision(Base, JsonBase):
     __tablename__ = 'articlerevision'
-    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+    __table_args__ = (Index('ix_articlerevision_page_id_created',
+                            'page_id', 'created'),
+                      {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'})
     __json__ = ["article", "summary"]
 
     id = Column(Integer, primary_key=True)
     page_id = Column(Integer, ForeignKey('articlepage.id'), nullable=False)
-    article = Column(UnicodeText, default='')
+    _article = Column('article', UnicodeText, default='')
     summary = Column(Unicode(128), index=True, nullable=True, default='')
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     user = relationship(User)
-    page = relationship("ArticlePage")
+    page = relationship("ArticlePage", foreign_keys=[page_id])
     created = Column(DateTime, default=datetime.now)
+    html = Column(UnicodeText, nullable=True)
+    plain = Column(UnicodeText, nullable=True)
+    html_renderer_id = Column(Integer, ForeignKey('articlerenderers.id'),
+                              nullable=True)
+    # How the text is stored, see lib/revisionstore.py
+    storage = Column(Integer, default=revisionstore.FULL, server_default='0',
+                     nullable=False)
+    data = Column(LargeBinary, nullable=True)
+    base_id = Column(Integer, index=True, nullable=True)
 
     def __init__(self, article="", summary="", user=None):
         self.article = article
@@ -37,6 +64,57 @@ class ArticleRevision(Base, JsonBase):
         if user:
             self.user = user
 
+    def _get_article(self):
+        if self.storage in (None, revisionstore.FULL):
+            return self._article
+        text = self.__dict__.get("_text")
+        if text is None and self.id:
+            text = revisionstore.text_cache.get(self.id)
+        if text is None:
+            text = revisionstore.unpack(self.storage, self._article,
+                                        self.data, self._get_base_text)
+            if self.id:
+                revisionstore.text_cache.set(self.id, text)
+        return text
+
+    def _set_article(self, article):
+        self._article = article
+        self.storage = revisionstore.FULL
+        self.data = None
+        self.base_id = None
+        self._text = None
+
+    def _get_base_text(self):
+        text = revisionstore.text_cache.get(self.base_id)
+        if text is None:
+            text = object_session(self).query(ArticleRevision).filter_by(
+                                                id=self.base_id).one().article
+        return text
+
+    article = synonym('_article',
+                      descriptor=property(_get_article, _set_article))
+
+    def pack(self, base=None, compress=True):
+        """
+        Store the text as a delta against a base snapshot revision if
+        that is smaller, optionally zlib compressed.
+        """
+        text = self.article
+        self.storage, self._article, self.data = revisionstore.pack(
+            text, base.article if base is not None else None, compress)
+        if self.storage in revisionstore.SNAPSHOTS:
+            self.base_id = None
+        else:
+            self.base_id = base.id
+        self._text = text
+
+    def to_dict(self):
+        result = JsonBase.to_dict(self)
+        for key in ("_article", "data", "storage", "base_id"):
+            result.pop(key, None)
+        result["article"] = self.article
+        return result
+
 class ArticleRenderers(Base):
     __tablename__ = 'articlerenderers'
     __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
@@ -51,24 +129,41 @@ class ArticlePage(Base, JsonBase):
     __tablename__ = 'articlepage'
     __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
     __json__ = ["name", "display_name", "hide_display_name", "private",
-                "view_count"]
+                "view_count", "up_count", "down_count"]
 
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(128), index=True, unique=True, nullable=False)
+    name_lower = Column(Unicode(128), index=True, nullable=True)
     display_name = Column(Unicode(128), index=True, nullable=False)
     hide_display_name = Column(Boolean, default=False, index=True)
     created = Column(DateTime, default=datetime.now)
     private = Column(Boolean, default=False, index=True)
     view_count = Column(Integer, default=0, index=True)
+    up_count = Column(Integer, default=0, server_default='0', nullable=False,
+                      index=True)
+    down_count = Column(Integer, default=0, server_default='0',
+                        nullable=False, index=True)
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     user = relationship(User)
     thread_id = Column(Integer, nullable=False, default=-1)
     album_id = Column(Integer, nullable=False, default=-1)
     renderer_id = Column(Integer, ForeignKey('articlerenderers.id'),
                          nullable=False, default=1)
+    current_revision_id = Column(Integer,
+                                 ForeignKey('articlerevision.id',
+                                            use_alter=True,
+                                            name='fk_articlepage_current'),
+                                 nullable=True)
+    # Hashes of the plain text and metadata last sent to the search index
+    index_hash = Column(Unicode(40), nullable=True)
+    index_meta_hash = Column(Unicode(40), nullable=True)
+    current_revision = relationship(ArticleRevision,
+                                    foreign_keys=[current_revision_id],
+                                    post_update=True)
     revisions = relationship(ArticleRevision,
                              cascade="all, delete, delete-orphan",
                              lazy="dynamic",
+                             foreign_keys=[ArticleRevision.page_id],
                              order_by=desc(ArticleRevision.created))
     tags = relationship(ArticleTags, cascade="all, delete, delete-orphan")
     votes = relationship("ArticleVotes", lazy="dynamic", 
@@ -79,9 +174,26 @@ class ArticlePage(Base, JsonBase):
         self.name = name
         self.display_name = display_name
 
+    def to_dict(self):
+        """
+        Include views counted but not yet written in view_count.
+        """
+        from .lib.viewcounter import view_counter
+        result = JsonBase.to_dict(self)
+        if "view_count" in result:
+            result["view_count"] = ((self.view_count or 0) +
+                                    view_counter.pending_count(self.id))
+        return result
+
+    @validates('name')
+    def validate_name(self, key, name):
+        self.name_lower = name.lower() if name else name
+        return name
+
 class ArticleVotes(Base):
     __tablename__ = 'articlevotes'
     __table_args__ = (UniqueConstraint('user_id', 'page_id'),
+                      Index('ix_articlevotes_page_id_like', 'page_id', 'like'),
                       {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'})
 
     id = Column(Integer, primary_key=True)
@@ -94,3 +206,17 @@ class ArticleVotes(Base):
     def __init__(self, user, like):
         self.user = user
         self.like = like
+
+class ArticleIndexQueue(Base):
+    __tablename__ = 'articleindexqueue'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    page_id = Column(Integer, index=True, unique=True, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    run_after = Column(DateTime, default=datetime.now, index=True)
+    last_error = Column(UnicodeText, nullable=True)
+    created = Column(DateTime, default=datetime.now)
+
+    def __init__(self, page_id):
+        self.page_id = page_id
@@ -1 +1,16 @@
-# package
+from pyramid.paster import bootstrap, get_appsettings
+from pyramid.request import Request
+
+def bootstrap_app(config_uri, app_url=None):
+    """
+    Bootstrap the application with a request for app_url, or the
+    article_app_url setting, so urls made by a script, such as the
+    ones sent to the search index, are the site's own.
+    Raise ValueError if neither is set.
+    """
+    if not app_url:
+        app_url = get_appsettings(config_uri).get("article_app_url")
+    if not app_url:
+        raise ValueError("Set article_app_url or pass --app-url")
+    return bootstrap(config_uri,
+                     request=Request.blank("/", base_url=app_url))
@@ -0,0 +1,389 @@
+from ..lib.articlelib import AlreadyVoted, ArticleLib, execute
+from ..lib.instrument import collecting, listen
+from ..models import ArticlePage, ArticleRevision, ArticleTags, ArticleVotes
+from ..views import article_list, article_list_revisions, article_read
+from pyracms.models import DBSession, User
+from pyramid.interfaces import IRoutesMapper
+from pyramid.paster import bootstrap, setup_logging
+from pyramid.renderers import render
+from pyramid.request import Request
+from pyramid.scripting import prepare
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql.functions import func
+from sqlalchemy.types import Boolean, Date, DateTime, Integer, String
+import argparse
+import datetime
+import json
+import random
+import sqlite3
+import sys
+import time
+import transaction
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua ut enim "
+         "ad minim veniam quis nostrud exercitation ullamco laboris nisi "
+         "aliquip ex ea commodo consequat").split()
+
+SCENARIOS = ("show_page", "article_read", "list", "article_list",
+             "article_list_revisions", "update", "add_vote", "to_json",
+             "from_json")
+
+# Scenarios that touch every page are run heavy_iterations times
+HEAVY = ("to_json", "from_json")
+
+def make_text(rng, size):
+    """
+    Make size characters of random text in short paragraphs.
+    """
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join([rng.choice(WORDS)
+                         for i in range(rng.randint(5, 15))]).capitalize()
+        lines.append(line + ".\n")
+        length += len(line) + 2
+    return "".join(lines)[:size]
+
+def edit_text(rng, text):
+    """
+    Change, add or remove a few lines, like an editor would.
+    """
+    lines = text.splitlines(True) or [""]
+    for i in range(rng.randint(1, 3)):
+        index = rng.randrange(len(lines))
+        action = rng.choice(("change", "add", "remove"))
+        line = make_text(rng, rng.randint(40, 120)).replace("\n", "") + "\n"
+        if action == "change":
+            lines[index] = line
+        elif action == "add":
+            lines.insert(index, line)
+        elif len(lines) > 1:
+            del lines[index]
+    return "".join(lines)
+
+def column_value(column, i):
+    """
+    Make a value for a required column of a synthetic user.
+    """
+    if isinstance(column.type, String):
+        value = "bench%s_%s" % (column.name, i)
+        return value[-column.type.length:] if column.type.length else value
+    if isinstance(column.type, Boolean):
+        return False
+    if isinstance(column.type, Integer):
+        return 0
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.now()
+    if isinstance(column.type, Date):
+        return datetime.date.today()
+    return None
+
+def create_users(count):
+    """
+    Insert count users, filling in every required column.
+    Returns their ids.
+    """
+    table = User.__table__
+    rows = []
+    for i in range(count):
+        row = {}
+        for column in table.columns:
+            if (column.primary_key or column.nullable or
+                column.default is not None or
+                column.server_default is not None):
+                continue
+            row[column.name] = column_value(column, i)
+        rows.append(row)
+    with transaction.manager:
+        execute(table.insert(), rows)
+    return [user_id for user_id, in DBSession.query(User.id).filter(
+                User.name.like("bench%")).order_by(User.id)]
+
+class Benchmark():
+    def __init__(self, registry, args):
+        self.registry = registry
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.a = ArticleLib()
+        self.mapper = registry.queryUtility(IRoutesMapper)
+        self.names = []
+        self.user_ids = []
+        self.backup = None
+        self.reused = False
+
+    def request(self, route_name=None, **matchdict):
+        """
+        Make a request with thread locals pushed. Returns the request,
+        its root and a closer.
+        """
+        path = "/"
+        route = None
+        if route_name:
+            route = self.mapper.get_route(route_name)
+            path = route.generate(matchdict)
+        request = Request.blank(path)
+        request.registry = self.registry
+        env = prepare(request=request, registry=self.registry)
+        request.matched_route = route
+        request.matchdict = matchdict
+        return request, env['root'], env['closer']
+
+    def generate(self):
+        """
+        Create the synthetic corpus unless the database has articles.
+        """
+        args = self.args
+        if DBSession.query(ArticlePage.id).first() is not None:
+            self.names = [name for name, in DBSession.query(ArticlePage.name)]
+            self.user_ids = [user_id for user_id, in DBSession.query(User.id)]
+            self.reused = True
+            return
+        self.user_ids = create_users(max(args.users, args.votes, 1))
+        tags = ["tag%s" % i for i in range(max(args.tags * 5, 1))]
+        start = time.time()
+        for first in range(0, args.pages, args.batch_size):
+            request, root, closer = self.request()
+            try:
+                with transaction.manager:
+                    users = DBSession.query(User).filter(
+                                        User.id.in_(self.user_ids)).all()
+                    for i in range(first, min(first + args.batch_size,
+                                              args.pages)):
+                        self.create_page(request, i, users, tags)
+            finally:
+                closer()
+            DBSession.remove()
+            print("Generated %s pages in %.1fs" %
+                  (min(first + args.batch_size, args.pages),
+                   time.time() - start), file=sys.stderr)
+
+    def describe(self):
+        """
+        Describe the corpus by the arguments it was generated with, or,
+        if it was already in the database, by per page averages
+        measured from it.
+        """
+        args = self.args
+        if not self.reused:
+            return {"reused": False, "pages": len(self.names),
+                    "revisions": args.revisions, "tags": args.tags,
+                    "votes": args.votes, "users": len(self.user_ids),
+                    "size": args.size, "seed": args.seed}
+        pages = float(len(self.names) or 1)
+        count = lambda model: DBSession.query(func.count(model.id)).scalar()
+        size = sum([len(revision.article) for revision in
+                    DBSession.query(ArticleRevision).join(ArticlePage,
+                        ArticlePage.current_revision_id == ArticleRevision.id)])
+        corpus = {"reused": True, "pages": len(self.names),
+                  "revisions": count(ArticleRevision) / pages,
+                  "tags": count(ArticleTags) / pages,
+                  "votes": count(ArticleVotes) / pages,
+                  "users": len(self.user_ids), "size": size / pages,
+                  "seed": None}
+        DBSession.remove()
+        return corpus
+
+    def create_page(self, request, i, users, tags):
+        args = self.args
+        rng = self.rng
+        name = "Bench_Page_%s" % i
+        text = make_text(rng, args.size)
+        page_tags = " ".join(rng.sample(tags, min(args.tags, len(tags))))
+        page = self.a.create(request, name, "Bench Page %s" % i, text,
+                             "Created", rng.choice(users), page_tags)
+        for revision in range(args.revisions - 1):
+            DBSession.flush()
+            text = edit_text(rng, text)
+            self.a.update(request, page, text, "Edit %s" % revision,
+                          rng.choice(users), page_tags)
+        DBSession.flush()
+        for user in rng.sample(users, min(args.votes, len(users))):
+            self.a.set_vote(page, user, rng.random() < 0.7)
+        self.names.append(name)
+
+    def run_show_page(self):
+        request, root, closer = self.request()
+        try:
+            self.a.show_page(self.rng.choice(self.names), request)
+        finally:
+            closer()
+
+    def run_view(self, view, template, route_name, **matchdict):
+        request, root, closer = self.request(route_name, **matchdict)
+        try:
+            result = view(root, request)
+            if isinstance(result, dict):
+                render(template, result, request)
+        finally:
+            closer()
+
+    def run_article_read(self):
+        self.run_view(article_read, "article/article.jinja2", "article_read",
+                      page_id=self.rng.choice(self.names))
+
+    def run_list(self):
+        self.a.list()
+
+    def run_article_list(self):
+        self.run_view(article_list, "article/article_list.jinja2",
+                      "article_list")
+
+    def run_article_list_revisions(self):
+        self.run_view(article_list_revisions,
+                      "article/article_list_revisions.jinja2",
+                      "article_list_revisions",
+                      page_id=self.rng.choice(self.names))
+
+    def run_update(self):
+        request, root, closer = self.request()
+        try:
+            with transaction.manager:
+                page = self.a.show_page(self.rng.choice(self.names), request)
+                user = DBSession.query(User).filter_by(
+                                    id=self.rng.choice(self.user_ids)).one()
+                self.a.update(request, page,
+                              edit_text(self.rng,
+                                        self.a.current_revision(page).article),
+                              "Benchmark edit", user)
+        finally:
+            closer()
+
+    def run_add_vote(self):
+        with transaction.manager:
+            page = self.a.show_page(self.rng.choice(self.names))
+            user = DBSession.query(User).filter_by(
+                                    id=self.rng.choice(self.user_ids)).one()
+            try:
+                self.a.add_vote(page, user, self.rng.random() < 0.5)
+            except AlreadyVoted:
+                pass
+
+    def run_to_json(self):
+        self.backup = self.a.to_json()
+
+    def run_from_json(self):
+        request, root, closer = self.request()
+        try:
+            with transaction.manager:
+                self.a.from_json(request, self.backup)
+        finally:
+            closer()
+
+    def measure(self, scenario):
+        """
+        Run a scenario, returning latency percentiles in milliseconds,
+        query counts and mean phase times.
+        """
+        if scenario == "from_json" and self.backup is None:
+            self.run_to_json()
+            DBSession.remove()
+        run = getattr(self, "run_" + scenario)
+        iterations = (self.args.heavy_iterations if scenario in HEAVY
+                      else self.args.iterations)
+        for i in range(min(self.args.warmup, iterations)):
+            run()
+            DBSession.remove()
+        times = []
+        queries = []
+        phases = {}
+        for i in range(iterations):
+            with collecting() as collector:
+                start = time.time()
+                run()
+                times.append((time.time() - start) * 1000)
+            DBSession.remove()
+            queries.append(len(collector.queries))
+            for name, seconds in collector.phases.items():
+                phases[name] = phases.get(name, 0.0) + seconds * 1000
+        times.sort()
+        return {"iterations": iterations,
+                "min_ms": times[0],
+                "mean_ms": sum(times) / len(times),
+                "p50_ms": percentile(times, 50),
+                "p90_ms": percentile(times, 90),
+                "p95_ms": percentile(times, 95),
+                "p99_ms": percentile(times, 99),
+                "max_ms": times[-1],
+                "queries_mean": float(sum(queries)) / len(queries),
+                "queries_max": max(queries),
+                "phases_mean_ms": dict([(name, value / iterations)
+                                        for name, value in phases.items()])}
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile of sorted values.
+    """
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def memory_engine(url):
+    """
+    Copy a SQLite database file into memory and return an engine for
+    the copy, so runs don't change the file.
+    """
+    source = sqlite3.connect(url.database)
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    source.backup(connection)
+    source.close()
+    return create_engine("sqlite://", creator=lambda: connection,
+                         poolclass=StaticPool)
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark article reads and writes on a SQLite "
+                    "database, generating a synthetic corpus if it has "
+                    "no articles. Prints results as JSON.")
+    parser.add_argument("config_uri",
+                        help='an ini file with a SQLite sqlalchemy.url that '
+                             'has been initialised, example: "bench.ini"')
+    parser.add_argument("--memory", action="store_true",
+                        help="Run on an in memory copy of the database")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--revisions", type=int, default=5,
+                        help="Revisions per page")
+    parser.add_argument("--tags", type=int, default=3, help="Tags per page")
+    parser.add_argument("--votes", type=int, default=10,
+                        help="Votes per page")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--size", type=int, default=4000,
+                        help="Article size in characters")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Pages generated per transaction")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--heavy-iterations", type=int, default=3,
+                        help="Iterations of to_json and from_json")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Scenario to run, may be repeated "
+                             "(default: all)")
+    parser.add_argument("--output", help="Write JSON here, not to stdout")
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    try:
+        engine = DBSession.get_bind()
+        if engine.url.get_backend_name() != "sqlite":
+            parser.error("sqlalchemy.url must be a SQLite database")
+        if args.memory:
+            DBSession.remove()
+            DBSession.configure(bind=memory_engine(engine.url))
+        listen()
+        benchmark = Benchmark(env['registry'], args)
+        benchmark.generate()
+        results = {"database": "memory" if args.memory else "file",
+                   "corpus": benchmark.describe(),
+                   "scenarios": {}}
+        for scenario in args.scenario or SCENARIOS:
+            print("Running %s" % scenario, file=sys.stderr)
+            results["scenarios"][scenario] = benchmark.measure(scenario)
+    finally:
+        env['closer']()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,145 @@
+from ..lib.articlelib import execute
+from ..lib.revisionstore import SNAPSHOTS
+from ..models import ArticlePage, ArticleRevision
+from pyracms.models import DBSession
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config
+import argparse
+import datetime
+import sys
+import transaction
+
+def select_revisions(revisions, current_id, now, keep_last=50,
+                     daily_after=None, weekly_after=None, squash=False):
+    """
+    Pick the revisions to keep from rows of (id, created, user_id),
+    newest first. The current revision and the newest keep_last are
+    always kept. Past daily_after days one revision a day is kept, past
+    weekly_after days one a week. With squash, a revision followed by
+    another from the same user is dropped.
+    """
+    keep = set([current_id])
+    buckets = set()
+    for i, (revision_id, created, user_id) in enumerate(revisions):
+        if i < keep_last:
+            keep.add(revision_id)
+            continue
+        if squash and i > 0 and revisions[i - 1][2] == user_id:
+            continue
+        if created is None:
+            keep.add(revision_id)
+            continue
+        age = now - created
+        if weekly_after is not None and age.days >= weekly_after:
+            bucket = ("week",) + tuple(created.isocalendar()[:2])
+        elif daily_after is not None and age.days >= daily_after:
+            bucket = ("day", created.date())
+        else:
+            keep.add(revision_id)
+            continue
+        if bucket not in buckets:
+            buckets.add(bucket)
+            keep.add(revision_id)
+    return keep
+
+def compact_page(page, now, dry_run=False, compress=True, **policy):
+    """
+    Delete a page's revisions that the policy doesn't keep.
+    Kept deltas whose snapshot is deleted become snapshots themselves,
+    zlib compressed if compress is set.
+    Returns the number of revisions and the number deleted.
+    """
+    rows = DBSession.query(ArticleRevision.id, ArticleRevision.created,
+                           ArticleRevision.user_id).filter(
+        ArticleRevision.page_id == page.id).order_by(
+        ArticleRevision.created.desc(), ArticleRevision.id.desc()).all()
+    if not rows:
+        return 0, 0
+    current_id = page.current_revision_id or rows[0][0]
+    keep = select_revisions(rows, current_id, now, **policy)
+    doomed = [row[0] for row in rows if row[0] not in keep]
+    if dry_run or not doomed:
+        return len(rows), len(doomed)
+    orphans = DBSession.query(ArticleRevision).filter(
+        ArticleRevision.page_id == page.id,
+        ArticleRevision.storage.notin_(SNAPSHOTS),
+        ArticleRevision.base_id.in_(doomed),
+        ArticleRevision.id.in_(list(keep))).all()
+    for revision in orphans:
+        text = revision.article
+        revision.article = text
+        revision.pack(None, compress)
+    DBSession.flush()
+    for i in range(0, len(doomed), 500):
+        execute(ArticleRevision.__table__.delete().where(
+            ArticleRevision.id.in_(doomed[i:i + 500])))
+    page.current_revision_id = current_id
+    return len(rows), len(doomed)
+
+def compact_revisions(batch_size=50, dry_run=False, page_name=None,
+                      verbose=False, compress=True, **policy):
+    """
+    Compact every page, or one page, committing every batch_size pages.
+    """
+    now = datetime.datetime.now()
+    last_id = 0
+    pages = total = deleted = 0
+    while True:
+        with transaction.manager:
+            query = DBSession.query(ArticlePage).filter(
+                                                ArticlePage.id > last_id)
+            if page_name:
+                query = query.filter(ArticlePage.name == page_name)
+            batch = query.order_by(ArticlePage.id).limit(batch_size).all()
+            if not batch:
+                break
+            for page in batch:
+                count, removed = compact_page(page, now, dry_run, compress,
+                                              **policy)
+                if verbose and removed:
+                    print("%s: %s of %s revisions %s" % (
+                        page.name, removed, count,
+                        "would be deleted" if dry_run else "deleted"))
+                total += count
+                deleted += removed
+            last_id = batch[-1].id
+            pages += len(batch)
+            if dry_run:
+                transaction.abort()
+    print("%s pages, %s revisions, %s %s" % (
+        pages, total, deleted, "would be deleted" if dry_run else "deleted"))
+    return pages, total, deleted
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Delete old article revisions by retention policy.")
+    parser.add_argument("config_uri", help='example: "development.ini"')
+    parser.add_argument("--keep-last", type=int, default=50,
+                        help="Revisions per page always kept")
+    parser.add_argument("--daily-after", type=int, metavar="DAYS",
+                        help="Keep one revision a day when older than this")
+    parser.add_argument("--weekly-after", type=int, metavar="DAYS",
+                        help="Keep one revision a week when older than this")
+    parser.add_argument("--squash-same-user", action="store_true",
+                        dest="squash",
+                        help="Keep only the last of a run of edits by the "
+                             "same user")
+    parser.add_argument("--page", dest="page_name",
+                        help="Only compact this page")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Pages per transaction")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report what would be deleted")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    compact_revisions(args.batch_size, args.dry_run, args.page_name,
+                      args.verbose,
+                      asbool(settings.get("article_revision_compress", True)),
+                      keep_last=args.keep_last,
+                      daily_after=args.daily_after,
+                      weekly_after=args.weekly_after, squash=args.squash)
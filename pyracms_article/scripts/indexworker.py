@@ -0,0 +1,63 @@
+from . import bootstrap_app
+from ..lib.articlelib import ArticleLib
+from pyramid.paster import setup_logging
+from threading import Thread
+import argparse
+import logging
+import sys
+import time
+import transaction
+
+log = logging.getLogger(__name__)
+
+def work(request, batch_size, interval, once):
+    """
+    Process the index queue until it is empty if once is set,
+    otherwise forever, sleeping for interval seconds when idle.
+    """
+    a = ArticleLib()
+    while True:
+        try:
+            with transaction.manager:
+                count = a.process_index_queue(request, batch_size)
+        except Exception:
+            log.exception("Processing the article index queue failed")
+            count = 0
+        if count:
+            log.info("Indexed %s articles", count)
+            continue
+        if once:
+            return
+        time.sleep(interval)
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Index articles queued by article_index_queue.")
+    parser.add_argument("config_uri", help='example: "development.ini"')
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=5,
+                        help="Seconds to wait when the queue is empty")
+    parser.add_argument("--once", action="store_true",
+                        help="Exit when the queue is empty")
+    parser.add_argument("--app-url",
+                        help="Site url for search index links, "
+                             "default: the article_app_url setting")
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    try:
+        env = bootstrap_app(args.config_uri, args.app_url)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        threads = [Thread(target=work, args=(env['request'], args.batch_size,
+                                             args.interval, args.once))
+                   for dummy in range(args.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        env['closer']()
@@ -1,7 +1,7 @@
 from pyracms import SettingsLib
 from ..models import ArticlePage, ArticleVotes, ArticleRevision # @UnusedImports
 from ..models import ArticleRenderers # @UnusedImports
-from ..models import ArticleTags # @UnusedImports
+from ..models import ArticleTags, ArticleTagCount # @UnusedImports
 from pyracms.factory import RootFactory
 from pyracms.lib.menulib import MenuLib
 from pyracms.lib.userlib import UserLib
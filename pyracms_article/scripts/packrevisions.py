@@ -0,0 +1,81 @@
+from ..models import ArticlePage, ArticleRevision
+from pyracms.models import DBSession
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import argparse
+import sys
+import transaction
+
+def pack_page(page, interval=20, compress=True, unpack=False,
+              drop_html=False):
+    """
+    Rewrite a page's revisions as a snapshot every interval revisions
+    with deltas in between, or as full text if unpack is set.
+    Returns the number of revisions rewritten.
+    """
+    revisions = page.revisions.order_by(None).order_by(
+        ArticleRevision.created, ArticleRevision.id).all()
+    # Rebuild every text before changing any rows they depend on
+    texts = [revision.article for revision in revisions]
+    snapshot = None
+    for i, revision in enumerate(revisions):
+        revision.article = texts[i]
+        if unpack:
+            pass
+        elif interval < 2 or i % interval == 0:
+            revision.pack(None, compress)
+            snapshot = revision
+        else:
+            revision.pack(snapshot, compress)
+        if drop_html and revision.id != page.current_revision_id:
+            revision.html = None
+            revision.plain = None
+            revision.html_renderer_id = None
+    return len(revisions)
+
+def pack_revisions(batch_size=50, interval=20, compress=True, unpack=False,
+                   drop_html=False):
+    """
+    Pack the revisions of every page, committing every batch_size pages.
+    """
+    last_id = 0
+    pages = 0
+    revisions = 0
+    while True:
+        with transaction.manager:
+            batch = DBSession.query(ArticlePage).filter(
+                ArticlePage.id > last_id).order_by(
+                ArticlePage.id).limit(batch_size).all()
+            if not batch:
+                break
+            for page in batch:
+                revisions += pack_page(page, interval, compress, unpack,
+                                       drop_html)
+            last_id = batch[-1].id
+            pages += len(batch)
+        print("Packed %s revisions of %s pages" % (revisions, pages))
+    return pages, revisions
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Convert article revisions to snapshot and delta "
+                    "storage, or back to full text.")
+    parser.add_argument("config_uri", help='example: "development.ini"')
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Pages per transaction")
+    parser.add_argument("--interval", type=int, default=20,
+                        help="Revisions per snapshot")
+    parser.add_argument("--no-compress", action="store_false",
+                        dest="compress")
+    parser.add_argument("--unpack", action="store_true",
+                        help="Store every revision as plain full text")
+    parser.add_argument("--drop-html", action="store_true",
+                        help="Forget stored html of old revisions, they "
+                             "are rendered on demand")
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    pack_revisions(args.batch_size, args.interval, args.compress,
+                   args.unpack, args.drop_html)
@@ -0,0 +1,40 @@
+from ..lib.articlelib import ArticleLib
+from ..models import ArticlePage
+from pyracms.models import DBSession
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import argparse
+import sys
+import transaction
+
+def reconcile_votes(batch_size=1000):
+    """
+    Recount vote tallies of every page in batches, committing each batch.
+    """
+    a = ArticleLib()
+    last_id = 0
+    total = 0
+    while True:
+        with transaction.manager:
+            page_ids = [page_id for page_id, in DBSession.query(
+                ArticlePage.id).filter(ArticlePage.id > last_id).order_by(
+                ArticlePage.id).limit(batch_size)]
+            if not page_ids:
+                break
+            a.count_votes(page_ids)
+        last_id = page_ids[-1]
+        total += len(page_ids)
+        print("Recounted votes for %s pages" % total)
+    return total
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Recount article vote tallies from the votes table.")
+    parser.add_argument("config_uri", help='example: "development.ini"')
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    reconcile_votes(args.batch_size)
@@ -0,0 +1,277 @@
+from . import bootstrap_app
+from ..lib.articlelib import ArticleLib, execute
+from ..lib.cachelib import text_cache
+from ..lib.revisionstore import SNAPSHOTS, unpack
+from ..models import ArticlePage, ArticleRenderers, ArticleRevision
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from jinja2.filters import do_striptags
+from pyracms.lib.widgetlib import WidgetLib
+from pyracms.models import DBSession, User
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.expression import bindparam, or_, select
+import argparse
+import sys
+import time
+import transaction
+
+def rerender(batch_size=500, force=False):
+    """
+    Store rendered html on revisions in batches, committing each batch.
+    Only revisions without html or rendered by another renderer are
+    done, unless force is set.
+    """
+    a = ArticleLib()
+    last_id = 0
+    total = 0
+    while True:
+        with transaction.manager:
+            query = DBSession.query(ArticleRevision).join(
+                ArticlePage, ArticleRevision.page_id == ArticlePage.id
+            ).options(joinedload(ArticleRevision.page
+                                 ).joinedload(ArticlePage.renderer))
+            if not force:
+                query = query.filter(or_(
+                    ArticleRevision.html == None,
+                    ArticleRevision.html_renderer_id != ArticlePage.renderer_id
+                ))
+            revisions = query.filter(ArticleRevision.id > last_id).order_by(
+                ArticleRevision.id).limit(batch_size).all()
+            if not revisions:
+                break
+            for revision in revisions:
+                a.prerender(revision.page, revision)
+            last_id = revisions[-1].id
+            total += len(revisions)
+        print("Rendered %s revisions" % total)
+    return total
+
+def render_chunk(items):
+    """
+    Render (revision id, renderer name, text) items in a worker process.
+    Returns (revision id, html, plain) tuples, html is None if the
+    renderer failed.
+    """
+    results = []
+    for revision_id, renderer, text in items:
+        try:
+            html = WidgetLib().render_article(renderer, text)
+        except Exception:
+            results.append((revision_id, None, None))
+            continue
+        results.append((revision_id, html, do_striptags(html)))
+    return results
+
+def stream_revisions(connection, force=False, reindex=False,
+                     read_size=500):
+    """
+    Yield revision rows to render, read read_size at a time in id order
+    so no cursor or lock is held while results are written back. With
+    reindex, only the current revision of each public page is read.
+    """
+    revisions = ArticleRevision.__table__
+    pages = ArticlePage.__table__
+    renderers = ArticleRenderers.__table__
+    users = User.__table__
+    query = select(revisions.c.id, revisions.c.page_id, revisions.c.article,
+                   revisions.c.storage, revisions.c.data, revisions.c.base_id,
+                   revisions.c.plain, revisions.c.html_renderer_id,
+                   revisions.c.created, pages.c.renderer_id,
+                   renderers.c.name.label("renderer"),
+                   users.c.name.label("username")).select_from(
+        revisions.join(pages, revisions.c.page_id == pages.c.id).join(
+        renderers, pages.c.renderer_id == renderers.c.id).join(
+        users, revisions.c.user_id == users.c.id))
+    if reindex:
+        query = query.where(pages.c.current_revision_id == revisions.c.id
+                    ).where(or_(pages.c.private == False,
+                                pages.c.private == None))
+    elif not force:
+        query = query.where(or_(
+            revisions.c.html == None,
+            revisions.c.html_renderer_id != pages.c.renderer_id))
+    last_id = 0
+    while True:
+        rows = connection.execute(query.where(revisions.c.id > last_id
+                    ).order_by(revisions.c.id).limit(read_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        for row in rows:
+            yield row
+
+def revision_text(row):
+    """
+    Rebuild a streamed revision's text, finding delta bases in the
+    revision cache or the database.
+    """
+    def load_base():
+        text = text_cache.get(row.base_id)
+        if text is None:
+            text = DBSession.query(ArticleRevision).filter_by(
+                                            id=row.base_id).one().article
+            text_cache.set(row.base_id, text)
+        return text
+    text = unpack(row.storage, row.article, row.data, load_base)
+    if row.storage in SNAPSHOTS:
+        text_cache.set(row.id, text)
+    return text
+
+class Writer():
+    """
+    Write rendered html back, and optionally send pages to the search
+    index, batch_size revisions per transaction.
+    """
+
+    def __init__(self, batch_size, request=None):
+        self.batch_size = batch_size
+        self.request = request
+        self.rendered = []
+        self.indexed = []
+        self.total_rendered = 0
+        self.total_indexed = 0
+        self.start = time.time()
+
+    def add(self, row, html=None, plain=None):
+        if html is not None:
+            self.rendered.append({"b_id": row.id, "b_html": html,
+                                  "b_plain": plain,
+                                  "b_renderer_id": row.renderer_id})
+        if self.request is not None:
+            self.indexed.append((row.page_id, row.created, row.username,
+                                 plain if html is not None else row.plain))
+        if len(self.rendered) + len(self.indexed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rendered and not self.indexed:
+            return
+        revisions = ArticleRevision.__table__
+        with transaction.manager:
+            if self.rendered:
+                execute(revisions.update().where(
+                    revisions.c.id == bindparam("b_id")).values(
+                    html=bindparam("b_html"), plain=bindparam("b_plain"),
+                    html_renderer_id=bindparam("b_renderer_id")),
+                    self.rendered)
+            if self.indexed:
+                self.index()
+        DBSession.remove()
+        self.total_rendered += len(self.rendered)
+        self.total_indexed += len(self.indexed)
+        self.rendered = []
+        self.indexed = []
+        seconds = time.time() - self.start
+        print("Rendered %s revisions, indexed %s pages in %.1fs, "
+              "%.1f revisions/s" % (self.total_rendered, self.total_indexed,
+                                    seconds, self.total_rendered / seconds
+                                    if seconds else 0.0))
+
+    def index(self):
+        a = ArticleLib()
+        pages = dict([(page.id, page) for page in
+                      DBSession.query(ArticlePage).filter(
+                        ArticlePage.id.in_([entry[0] for entry
+                                            in self.indexed])).options(
+                        joinedload(ArticlePage.tags))])
+        for page_id, created, username, plain in self.indexed:
+            page = pages.get(page_id)
+            if page is None:
+                continue
+            tags = a.t.get_tags(page)
+            a.s.update_index(page.display_name,
+                             self.request.route_url("article_read",
+                                                    page_id=page.name),
+                             plain or "", tags, created,
+                             "article", page.name, username)
+            page.index_hash, page.index_meta_hash = a.index_hashes(
+                                                        page, plain, tags)
+
+def parallel_rerender(workers, batch_size=500, force=False, request=None,
+                      chunk_size=50):
+    """
+    Render revisions on a pool of worker processes. Revisions are read
+    from the database as they are needed and sent to workers chunk_size
+    at a time, with at most two chunks per worker in flight so memory
+    use stays flat. Results are written back batch_size at a time. With a
+    request, the current revision of every public page is read and
+    sent to the search index, and only stale ones are rendered.
+    Returns the number of revisions rendered.
+    """
+    writer = Writer(batch_size, request)
+    pending = {}
+    rows = {}
+
+    def collect(done):
+        for future in done:
+            for revision_id, html, plain in future.result():
+                writer.add(rows.pop(revision_id), html, plain)
+            del pending[future]
+
+    connection = DBSession.get_bind().connect()
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            chunk = []
+            for row in stream_revisions(connection, force,
+                                        request is not None, batch_size):
+                if (request is not None and not force and
+                        row.plain is not None and
+                        row.html_renderer_id == row.renderer_id):
+                    writer.add(row)
+                    continue
+                rows[row.id] = row
+                chunk.append((row.id, row.renderer, revision_text(row)))
+                if len(chunk) < chunk_size:
+                    continue
+                pending[executor.submit(render_chunk, chunk)] = True
+                chunk = []
+                if len(pending) >= workers * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            if chunk:
+                pending[executor.submit(render_chunk, chunk)] = True
+            collect(wait(pending).done)
+        writer.flush()
+    finally:
+        connection.close()
+    return writer.total_rendered
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Store rendered html for article revisions.")
+    parser.add_argument("config_uri", help='example: "development.ini"')
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--all", action="store_true", dest="force",
+                        help="Render every revision, not just stale ones")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Render on this many processes")
+    parser.add_argument("--chunk-size", type=int, default=50,
+                        help="Revisions sent to a worker at a time")
+    parser.add_argument("--reindex", action="store_true",
+                        help="Send the current revision of every public "
+                             "page to the search index, implies --workers")
+    parser.add_argument("--app-url",
+                        help="Site url for search index links with "
+                             "--reindex, default: the article_app_url "
+                             "setting")
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    if args.reindex:
+        try:
+            env = bootstrap_app(args.config_uri, args.app_url)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            parallel_rerender(max(args.workers, 1), args.batch_size,
+                              args.force, env['request'], args.chunk_size)
+        finally:
+            env['closer']()
+        return
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    if args.workers > 1:
+        parallel_rerender(args.workers, args.batch_size, args.force,
+                          chunk_size=args.chunk_size)
+    else:
+        rerender(args.batch_size, args.force)
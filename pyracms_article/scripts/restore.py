@@ -0,0 +1,46 @@
+from . import bootstrap_app
+from ..lib.articlelib import ArticleLib
+from pyramid.paster import setup_logging
+import argparse
+import sys
+import time
+import transaction
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Restore articles from a backup file, committing "
+                    "every batch.")
+    parser.add_argument("config_uri", help='example: "development.ini"')
+    parser.add_argument("backup_file",
+                        help="JSON or NDJSON backup, may be gzip compressed")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--resume", action="store_true",
+                        help="Keep existing pages and skip them, to carry "
+                             "on after an interrupted restore")
+    parser.add_argument("--app-url",
+                        help="Site url for search index links, "
+                             "default: the article_app_url setting")
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    try:
+        env = bootstrap_app(args.config_uri, args.app_url)
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.time()
+
+    def progress(pages, revisions):
+        print("Restored %s pages and %s revisions in %.1fs" %
+              (pages, revisions, time.time() - start))
+
+    def commit():
+        transaction.commit()
+        transaction.begin()
+
+    try:
+        transaction.begin()
+        with open(args.backup_file, "rb") as fp:
+            ArticleLib().restore(env['request'], fp, args.batch_size,
+                                 args.resume, progress, commit)
+        transaction.commit()
+    finally:
+        env['closer']()
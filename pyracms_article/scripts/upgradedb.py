@@ -0,0 +1,111 @@
+from ..lib.articlelib import count_tags_select, count_votes_statement
+from ..models import ArticlePage, ArticleVotes, ArticleRevision # @UnusedImports
+from ..models import ArticleRenderers # @UnusedImports
+from ..models import ArticleTags, ArticleTagCount # @UnusedImports
+from pyracms.models import DBSession, Base
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config, inspect
+from sqlalchemy.sql.expression import bindparam, desc, select, text
+import os
+import sys
+
+TABLES = [ArticleRenderers.__table__, ArticlePage.__table__,
+          ArticleRevision.__table__, ArticleTags.__table__,
+          ArticleTagCount.__table__, ArticleVotes.__table__]
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def add_missing_columns(engine):
+    """
+    Add columns and indexes that were added to the models after the
+    tables were created. New columns must be nullable or have a
+    server default.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for table in TABLES:
+            if table.name not in existing_tables:
+                continue
+            columns = [c["name"] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                    quote(table.name), quote(column.name),
+                    column.type.compile(dialect=engine.dialect))
+                if column.server_default is not None:
+                    ddl += " DEFAULT %s" % column.server_default.arg
+                print("Adding column %s.%s" % (table.name, column.name))
+                connection.execute(text(ddl))
+            indexes = [i["name"] for i in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in indexes:
+                    print("Adding index %s" % index.name)
+                    index.create(connection)
+
+def backfill_name_lower(connection):
+    """
+    Fill in the normalized page name used for case insensitive lookups.
+    """
+    table = ArticlePage.__table__
+    rows = connection.execute(select(table.c.id, table.c.name).where(
+                                        table.c.name_lower == None)).fetchall()
+    if rows:
+        connection.execute(table.update().where(
+            table.c.id == bindparam("page_id")).values(
+            name_lower=bindparam("lower")),
+            [{"page_id": row.id, "lower": row.name.lower()} for row in rows])
+
+def backfill_current_revision(connection):
+    """
+    Point pages at their latest revision.
+    """
+    pages = ArticlePage.__table__
+    revisions = ArticleRevision.__table__
+    latest = select(revisions.c.id).where(
+        revisions.c.page_id == pages.c.id).order_by(
+        desc(revisions.c.created), desc(revisions.c.id)).limit(1)
+    connection.execute(pages.update().where(
+        pages.c.current_revision_id == None).values(
+        current_revision_id=latest.scalar_subquery()))
+
+def backfill_vote_counts(connection):
+    """
+    Count votes into the page vote tallies.
+    """
+    connection.execute(count_votes_statement())
+
+def backfill_tag_counts(connection):
+    """
+    Recount public pages for each tag.
+    """
+    counts = ArticleTagCount.__table__
+    connection.execute(counts.delete())
+    connection.execute(counts.insert().from_select(["name", "count"],
+                                                   count_tags_select()))
+
+# Data migrations, run in order after the schema is upgraded.
+# Each step takes a connection and must be safe to run more than once.
+UPGRADE_STEPS = [backfill_name_lower, backfill_current_revision,
+                 backfill_vote_counts, backfill_tag_counts]
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    for step in UPGRADE_STEPS:
+        print("Running %s" % step.__name__)
+        with engine.begin() as connection:
+            step(connection)
@@ -1,3 +1,5 @@
+import datetime
+import io
 import unittest
 import transaction
 
@@ -5,6 +7,20 @@ from pyramid import testing
 
 from pyracms.models import DBSession
 
+TEXT = "".join(["Line %s of an article\r\n" % i for i in range(40)]
+               ) + "\x0cA new page\nwithout a final newline"
+
+def edits(count):
+    """
+    Make count versions of TEXT, each changing a line of the last.
+    """
+    lines = TEXT.splitlines(True)
+    texts = []
+    for i in range(count):
+        lines[(i * 7) % len(lines)] = "Edit %s\r\n" % i
+        texts.append("".join(lines))
+    return texts
+
 class TestMyView(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
@@ -28,4 +44,415 @@ class TestMyView(unittest.TestCase):
         self.assertEqual(info['one'].name, 'one')
         self.assertEqual(info['project'], 'pyracms')
         """
-        pass
\ No newline at end of file
+        pass
+
+class DatabaseTest(unittest.TestCase):
+    settings = {}
+
+    def setUp(self):
+        self.config = testing.setUp(settings=self.settings)
+        self.create_database()
+
+    def create_database(self):
+        """
+        Bind the session to a new empty database.
+        """
+        from sqlalchemy import create_engine
+        from .lib.cachelib import text_cache
+        from .models import Base
+        DBSession.remove()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        text_cache.clear()
+
+    def tearDown(self):
+        from .lib.cachelib import text_cache
+        text_cache.clear()
+        DBSession.remove()
+        testing.tearDown()
+
+    def add_user(self, user_id=1):
+        from .lib.articlelib import execute
+        from .scripts.benchmark import column_value
+        from pyracms.models import User
+        table = User.__table__
+        row = dict([(column.name, column_value(column, user_id))
+                    for column in table.columns
+                    if not (column.primary_key or column.nullable or
+                            column.default is not None or
+                            column.server_default is not None)])
+        row["id"] = user_id
+        execute(table.insert().values(**row))
+        return user_id
+
+    def add_page(self, name):
+        from .models import ArticlePage
+        page = ArticlePage(name, name)
+        page.user_id = 1
+        DBSession.add(page)
+        DBSession.flush()
+        return page
+
+    def add_revision(self, page, text, created=None):
+        from .models import ArticleRevision
+        revision = ArticleRevision(text, "Edit")
+        revision.user_id = 1
+        revision.page = page
+        revision.created = created or datetime.datetime.now()
+        DBSession.add(revision)
+        DBSession.flush()
+        return revision
+
+    def add_history(self, name, texts):
+        start = datetime.datetime(2020, 1, 1)
+        with transaction.manager:
+            page = self.add_page(name)
+            for i, text in enumerate(texts):
+                revision = self.add_revision(
+                    page, text, start + datetime.timedelta(minutes=i))
+            page.current_revision_id = revision.id
+
+    def get_page(self, name):
+        from .models import ArticlePage
+        return DBSession.query(ArticlePage).filter_by(name=name).one()
+
+    def stored(self, name):
+        """
+        Load a page's revisions, oldest first, without cached text.
+        """
+        from .lib.cachelib import text_cache
+        from .models import ArticleRevision
+        DBSession.remove()
+        text_cache.clear()
+        return DBSession.query(ArticleRevision).filter_by(
+            page_id=self.get_page(name).id).order_by(ArticleRevision.id).all()
+
+class TestRevisionStore(unittest.TestCase):
+    def assertRoundTrip(self, text, base, compress):
+        from .lib.revisionstore import pack, unpack
+        storage, article, data = pack(text, base, compress)
+        self.assertEqual(unpack(storage, article, data, lambda: base), text)
+        return storage
+
+    def test_round_trip(self):
+        texts = [TEXT, TEXT + "\n", "", "one line", "\x0c\r\n\r",
+                 "a\rb\r\nc\x0cd\x1ce\u2028f"] + edits(3)
+        for base in (None, "", TEXT):
+            for text in texts:
+                for compress in (True, False):
+                    self.assertRoundTrip(text, base, compress)
+
+    def test_storage(self):
+        from .lib.revisionstore import DELTA, DELTA_ZLIB, FULL, FULL_ZLIB
+        text = edits(1)[0]
+        self.assertEqual(self.assertRoundTrip(text, None, False), FULL)
+        self.assertEqual(self.assertRoundTrip(text, None, True), FULL_ZLIB)
+        self.assertEqual(self.assertRoundTrip(text, TEXT, False), DELTA)
+        self.assertIn(self.assertRoundTrip(text, TEXT, True),
+                      (DELTA, DELTA_ZLIB))
+        self.assertEqual(self.assertRoundTrip("short", "other", True), FULL)
+
+class TestStoreRevision(DatabaseTest):
+    settings = {"article_snapshot_interval": "3",
+                "article_revision_compress": "false"}
+
+    def test_snapshot_interval(self):
+        from .lib.articlelib import ArticleLib
+        from .lib.revisionstore import DELTA, FULL
+        from .models import ArticleRevision
+        texts = edits(8)
+        with transaction.manager:
+            page = self.add_page("Interval")
+            previous = None
+            for text in texts:
+                revision = ArticleRevision(text, "Edit")
+                revision.user_id = 1
+                revision.page = page
+                ArticleLib().store_revision(revision, previous)
+                DBSession.add(revision)
+                DBSession.flush()
+                previous = revision
+        revisions = self.stored("Interval")
+        self.assertEqual([revision.storage for revision in revisions],
+                         [FULL, DELTA, DELTA] * 2 + [FULL, DELTA])
+        self.assertEqual([revision.base_id for revision in revisions],
+                         [None] + [revisions[0].id] * 2 +
+                         [None] + [revisions[3].id] * 2 +
+                         [None, revisions[6].id])
+        self.assertEqual([revision.article for revision in revisions], texts)
+
+class TestPackRevisions(DatabaseTest):
+    def test_pack_and_unpack(self):
+        from .lib.revisionstore import FULL, SNAPSHOTS
+        from .scripts.packrevisions import pack_page
+        texts = edits(7)
+        self.add_history("Packed", texts)
+        with transaction.manager:
+            self.assertEqual(pack_page(self.get_page("Packed"), 3), 7)
+        revisions = self.stored("Packed")
+        self.assertEqual([revision.storage in SNAPSHOTS
+                          for revision in revisions],
+                         [True, False, False] * 2 + [True])
+        self.assertEqual([revision.base_id for revision in revisions],
+                         [None] + [revisions[0].id] * 2 +
+                         [None] + [revisions[3].id] * 2 + [None])
+        self.assertEqual([revision.article for revision in revisions], texts)
+        with transaction.manager:
+            self.assertEqual(pack_page(self.get_page("Packed"),
+                                       unpack=True), 7)
+        revisions = self.stored("Packed")
+        self.assertEqual([(revision.storage, revision.base_id, revision.data)
+                          for revision in revisions], [(FULL, None, None)] * 7)
+        self.assertEqual([revision.article for revision in revisions], texts)
+
+class TestSelectRevisions(unittest.TestCase):
+    now = datetime.datetime(2020, 2, 10, 12)
+
+    def select(self, rows, current_id, **policy):
+        from .scripts.compactrevisions import select_revisions
+        return select_revisions(rows, current_id, self.now, **policy)
+
+    def test_keep_last(self):
+        old = datetime.datetime(2019, 1, 1)
+        rows = [(i, old, 1) for i in range(5, 0, -1)]
+        self.assertEqual(self.select(rows, 5, keep_last=2, weekly_after=7),
+                         set([5, 4, 3]))
+        self.assertEqual(self.select(rows, 5, keep_last=10, weekly_after=7),
+                         set([5, 4, 3, 2, 1]))
+        self.assertEqual(self.select(rows, 5, keep_last=2),
+                         set([5, 4, 3, 2, 1]))
+
+    def test_daily(self):
+        rows = [(5, datetime.datetime(2020, 2, 10, 8), 1),
+                (4, datetime.datetime(2020, 2, 1, 18), 1),
+                (3, datetime.datetime(2020, 2, 1, 9), 1),
+                (2, datetime.datetime(2020, 1, 31, 20), 1),
+                (1, datetime.datetime(2020, 1, 31, 8), 1)]
+        self.assertEqual(self.select(rows, 5, keep_last=0, daily_after=1),
+                         set([5, 4, 2]))
+
+    def test_weekly(self):
+        rows = [(4, datetime.datetime(2020, 2, 5), 1),
+                (3, datetime.datetime(2020, 1, 13), 1),
+                (2, datetime.datetime(2020, 1, 8), 1),
+                (1, datetime.datetime(2020, 1, 6), 1)]
+        self.assertEqual(self.select(rows, 4, keep_last=0, daily_after=1,
+                                     weekly_after=14), set([4, 3, 2]))
+
+    def test_squash(self):
+        rows = [(i, self.now, user_id)
+                for i, user_id in zip(range(5, 0, -1), (1, 1, 2, 2, 1))]
+        self.assertEqual(self.select(rows, 5, keep_last=0, squash=True),
+                         set([5, 3, 1]))
+        self.assertEqual(self.select(rows, 5, keep_last=3, squash=True),
+                         set([5, 4, 3, 1]))
+
+    def test_current(self):
+        old = datetime.datetime(2019, 1, 1)
+        rows = [(i, old, 1) for i in range(5, 0, -1)]
+        self.assertEqual(self.select(rows, 2, keep_last=0, weekly_after=7),
+                         set([5, 2]))
+        self.assertEqual(self.select(rows, 4, keep_last=0, squash=True),
+                         set([5, 4]))
+
+class TestCompactPage(DatabaseTest):
+    now = datetime.datetime(2020, 1, 20)
+
+    def compact(self, compress):
+        from .scripts.compactrevisions import compact_page
+        from .scripts.packrevisions import pack_page
+        texts = edits(5)
+        self.add_history("Compacted", texts)
+        with transaction.manager:
+            pack_page(self.get_page("Compacted"), 5)
+        ids = [revision.id for revision in self.stored("Compacted")]
+        with transaction.manager:
+            self.assertEqual(compact_page(self.get_page("Compacted"),
+                                          self.now, True, compress,
+                                          keep_last=2, daily_after=1), (5, 2))
+        self.assertEqual(len(self.stored("Compacted")), 5)
+        with transaction.manager:
+            self.assertEqual(compact_page(self.get_page("Compacted"),
+                                          self.now, False, compress,
+                                          keep_last=2, daily_after=1), (5, 2))
+        revisions = self.stored("Compacted")
+        self.assertEqual([revision.id for revision in revisions], ids[2:])
+        self.assertEqual([revision.base_id for revision in revisions],
+                         [None] * 3)
+        self.assertEqual([revision.article for revision in revisions],
+                         texts[2:])
+        self.assertEqual(self.get_page("Compacted").current_revision_id,
+                         ids[-1])
+        return [revision.storage for revision in revisions]
+
+    def test_rewrites_orphans(self):
+        from .lib.revisionstore import FULL_ZLIB
+        self.assertEqual(self.compact(True), [FULL_ZLIB] * 3)
+
+    def test_rewrites_orphans_uncompressed(self):
+        from .lib.revisionstore import FULL
+        self.assertEqual(self.compact(False), [FULL] * 3)
+
+class TestBackup(DatabaseTest):
+    settings = {"article_index_queue": "true"}
+
+    def round_trip(self, ndjson):
+        from .lib.articlelib import ArticleLib
+        texts = edits(7)
+        start = datetime.datetime(2020, 1, 1, 12)
+        with transaction.manager:
+            self.add_user()
+            page = self.add_page("Backup")
+            for i, text in enumerate(texts):
+                revision = self.add_revision(
+                    page, text, start + datetime.timedelta(microseconds=i))
+            page.current_revision_id = revision.id
+        ids = [revision.id for revision in self.stored("Backup")]
+        backup = "".join(ArticleLib().iter_json(ndjson))
+        self.create_database()
+        self.config.add_route("article_read", "/article/item/{page_id}")
+        request = testing.DummyRequest()
+        with transaction.manager:
+            self.add_user()
+            self.assertEqual(ArticleLib().restore(request,
+                                                  io.StringIO(backup)),
+                             (1, 7))
+        revisions = self.stored("Backup")
+        self.assertEqual([revision.id for revision in revisions], ids)
+        self.assertEqual([revision.article for revision in revisions], texts)
+        page = self.get_page("Backup")
+        self.assertEqual(page.current_revision_id, ids[-1])
+        self.assertEqual(page.current_revision.article, texts[-1])
+
+    def test_round_trip(self):
+        self.round_trip(False)
+
+    def test_round_trip_ndjson(self):
+        self.round_trip(True)
+
+class TestListPages(DatabaseTest):
+    def test_paging(self):
+        from .lib.articlelib import ArticleLib
+        created = datetime.datetime(2020, 1, 1)
+        with transaction.manager:
+            for i, (views, day) in enumerate([(None, None), (3, 1), (0, 1),
+                                              (3, None), (None, 2), (5, 3),
+                                              (1, 2)]):
+                page = self.add_page("Page_%s" % i)
+                page.view_count = views
+                page.created = (created + datetime.timedelta(days=day)
+                                if day is not None else None)
+                page.up_count = i % 3
+        a = ArticleLib()
+        for sort in ("name", "created", "view_count", "votes"):
+            for descending in (False, True):
+                expected = [row.id for row in a.list_pages(
+                                    100, None, sort, descending)[0]]
+                self.assertEqual(len(expected), 7)
+                ids = []
+                cursor = None
+                while True:
+                    rows, cursor = a.list_pages(2, cursor, sort, descending)
+                    ids.extend([row.id for row in rows])
+                    if cursor is None:
+                        break
+                self.assertEqual(ids, expected, (sort, descending))
+
+class TestVotes(DatabaseTest):
+    def test_set_vote(self):
+        from .lib.articlelib import AlreadyVoted, ArticleLib
+        from .models import ArticleVotes
+        from pyracms.models import User
+        a = ArticleLib()
+        with transaction.manager:
+            self.add_user(1)
+            self.add_user(2)
+            self.add_page("Voted")
+        with transaction.manager:
+            page = self.get_page("Voted")
+            first, second = DBSession.query(User).order_by(User.id).all()
+            self.assertEqual(a.set_vote(page, first, True),
+                             {"up_count": 1, "down_count": 0, "like": True,
+                              "changed": True})
+            self.assertEqual(a.set_vote(page, first, True),
+                             {"up_count": 1, "down_count": 0, "like": True,
+                              "changed": False})
+            self.assertRaises(AlreadyVoted, a.add_vote, page, first, True)
+            self.assertEqual(a.set_vote(page, first, False),
+                             {"up_count": 0, "down_count": 1, "like": False,
+                              "changed": True})
+            self.assertEqual(a.set_vote(page, second, False),
+                             {"up_count": 0, "down_count": 2, "like": False,
+                              "changed": True})
+        page = self.get_page("Voted")
+        self.assertEqual((page.up_count, page.down_count), (0, 2))
+        self.assertEqual(sorted([(vote.user_id, vote.like) for vote in
+                                 DBSession.query(ArticleVotes)]),
+                         [(1, False), (2, False)])
+
+class TestRevisionDiff(unittest.TestCase):
+    def apply(self, a, diff):
+        """
+        Rebuild the new text from the old text and a diff.
+        """
+        a_lines = a.splitlines(True)
+        lines = []
+        position = 0
+        for hunk in diff["hunks"]:
+            lines.extend(a_lines[position:hunk["a_start"]])
+            self.assertEqual([text for op, text in hunk["lines"]
+                              if op != "+"],
+                             a_lines[hunk["a_start"]:hunk["a_end"]])
+            lines.extend([text for op, text in hunk["lines"] if op != "-"])
+            position = hunk["a_end"]
+        lines.extend(a_lines[position:])
+        return "".join(lines)
+
+    def test_group_opcodes(self):
+        from .lib.revisiondiff import group_opcodes
+        self.assertEqual(group_opcodes([("equal", 0, 10, 0, 10),
+                                        ("replace", 10, 11, 10, 11),
+                                        ("equal", 11, 30, 11, 30),
+                                        ("delete", 30, 31, 30, 30),
+                                        ("equal", 31, 33, 30, 32)], 2),
+                         [[("equal", 8, 10, 8, 10),
+                           ("replace", 10, 11, 10, 11),
+                           ("equal", 11, 13, 11, 13)],
+                          [("equal", 28, 30, 28, 30),
+                           ("delete", 30, 31, 30, 30),
+                           ("equal", 31, 33, 30, 32)]])
+        self.assertEqual(group_opcodes([("equal", 0, 5, 0, 5)], 3), [])
+
+    def test_diff_texts(self):
+        from .lib.revisiondiff import diff_texts
+        a = "".join(["line %s\n" % i for i in range(20)])
+        old = a.replace("line 10\n", "the slow fox\n")
+        new = a.replace("line 10\n", "the quick fox\n")
+        diff = diff_texts(old, new)
+        self.assertFalse(diff["fast"])
+        self.assertEqual([(hunk["a_start"], hunk["a_end"])
+                          for hunk in diff["hunks"]], [(7, 14)])
+        self.assertEqual(diff["hunks"][0]["words"],
+                         [[("equal", "the "), ("delete", "slow"),
+                           ("insert", "quick"), ("equal", " fox\n")]])
+        self.assertEqual(diff_texts(a, a)["hunks"], [])
+
+    def test_round_trip(self):
+        from .lib.revisiondiff import diff_texts
+        texts = [TEXT, "", "one line", TEXT + "\n"] + edits(5)
+        for a in texts:
+            for b in texts:
+                for max_lines in (2000, 5):
+                    self.assertEqual(self.apply(a, diff_texts(
+                                        a, b, max_lines=max_lines)), b)
+
+class TestLRUCache(unittest.TestCase):
+    def test_delete_if(self):
+        from .lib.cachelib import LRUCache
+        cache = LRUCache(10)
+        for key in [(1, 2), (2, 3), (4, 5)]:
+            cache.set(key, key)
+        cache.delete_if(lambda key: 2 in key)
+        self.assertEqual([cache.get(key) for key in [(1, 2), (2, 3), (4, 5)]],
+                         [None, None, (4, 5)])
@@ -1,16 +1,24 @@
 from pyracms.deform_schemas.userarea_admin import RestoreBackupSchema
-from pyracms.lib.helperlib import (redirect, get_username, rapid_deform,
-                                   display_json)
+from pyracms.lib.helperlib import redirect, get_username, rapid_deform
 from pyracms.lib.settingslib import SettingsLib
 from pyracms.lib.taglib import TagLib, ARTICLE
 from pyracms.lib.userlib import UserLib
 from pyracms.views import ERROR, INFO
 from pyracms_article.deform_schemas.article import EditArticleSchema
 from pyracms_article.lib.articlelib import (ArticleLib, PageNotFound,
-                                            AlreadyVoted)
+                                            InvalidCursor, RevisionNotFound,
+                                            buffer_chunks)
+from pyracms_article.lib.cachelib import diff_cache, render_cache, text_cache
+from pyracms_article.lib.instrument import metrics, phase
+from pyracms_article.lib.menucache import check_permission, menu_cache
+from pyracms_article.lib.pagecache import page_cache, surrogate_keys
+from pyracms_article.lib.responselib import conditional_response
+from pyracms_article.lib.viewcounter import view_counter
 from pyracms_article.models import ArticleTags
 from pyramid.httpexceptions import HTTPForbidden
-from pyramid.security import has_permission
+from pyramid.renderers import render, render_to_response
+from pyramid.response import Response
+from pyramid.security import authenticated_userid
 from pyramid.view import view_config
 
 u = UserLib()
@@ -20,8 +28,8 @@ s = SettingsLib()
 def check_owner(context, request):
     page_id = request.matchdict.get('page_id')
     g = ArticleLib()
-    page = g.show_page(page_id)
-    if (has_permission('article_mod', context, request) or
+    page = g.show_page(page_id, request)
+    if (check_permission('article_mod', context, request) or
                 page.user == u.show(get_username(request))):
         return True
     else:
@@ -34,36 +42,96 @@ def check_owner(context, request):
              renderer='article/article.jinja2', permission='article_view')
 def article_read(context, request):
     """
-    Display an article
+    Display an article, answering conditional requests with 304
     """
     c = ArticleLib()
     result = {}
     page_id = request.matchdict.get('page_id') or "Front_Page"
     revision_id = request.matchdict.get('revision')
     try:
-        page = c.show_page(page_id)
+        page = c.show_page(page_id, request)
         if revision_id:
             revision = c.show_revision(page, revision_id)
         else:
-            revision = page.revisions[0]
-        if page.private and not has_permission("set_private", context,
-                                               request):
+            revision = c.current_revision(page)
+        if page.private and not check_permission("set_private", context,
+                                                 request):
             raise HTTPForbidden
         else:
+            view_counter.incr(page.id)
+            comments = (request.query_string.startswith("comments") and
+                        page.thread_id != -1)
+            flashed = (request.session.peek_flash(INFO) or
+                       request.session.peek_flash(ERROR))
+            if revision and not comments and not flashed:
+                not_modified = conditional_response(request, page, revision,
+                                                    bool(revision_id))
+                if not_modified:
+                    return not_modified
+                request.response.headers["Surrogate-Key"] = surrogate_keys(
+                                                        page.name, revision_id)
+            cacheable = (page_cache.enabled and revision and not comments and
+                         not authenticated_userid(request) and not flashed)
+            if cacheable:
+                body = page_cache.get(page.name, revision_id,
+                                      request.host_url)
+                if body is not None:
+                    request.response.text = body
+                    return request.response
             result.update({'page': page, 'revision': revision,
+                           'rendered': (c.render(page, revision)
+                                        if revision else ""),
                            "revision_id": revision_id,
+                           "menu_cache": menu_cache,
                            "thread_enabled": False})
-
-            if (request.query_string.startswith("comments") and
-                        page.thread_id != -1):
+            if cacheable:
+                body = render('article/article.jinja2', result, request)
+                page_cache.set(page.name, revision_id, request.host_url,
+                               body)
+                request.response.text = body
+                return request.response
+            if comments:
                 from pyracms_forum.views import get_thread
-                result.update(get_thread(context, request, page.thread_id))
+                with phase("comments"):
+                    result.update(get_thread(context, request,
+                                             page.thread_id))
                 result.update({"thread_enabled": True})
             return result
     except PageNotFound:
         return redirect(request, "article_create", page_id=page_id)
 
 
+@view_config(route_name='article_stats', permission='article_mod',
+             renderer='json')
+def article_stats(context, request):
+    """
+    Show cache counters, index queue depth and unwritten views
+    """
+    return {'render_cache': render_cache.stats(),
+            'index_queue_depth': ArticleLib().index_queue_depth(),
+            'pending_views': view_counter.total}
+
+
+def article_metrics(context, request):
+    """
+    Show request timings, query counts, cache counters and queue depths
+    in the Prometheus text format
+    """
+    gauges = []
+    for name, cache in (("render", render_cache), ("text", text_cache),
+                        ("diff", diff_cache)):
+        stats = cache.stats()
+        for key in ("hits", "misses", "size"):
+            gauges.append(("article_cache_%s" % key, {"cache": name},
+                           stats[key]))
+    gauges.append(("article_index_queue_depth", {},
+                   ArticleLib().index_queue_depth()))
+    gauges.append(("article_pending_views", {}, view_counter.total))
+    return Response(metrics.prometheus(gauges),
+                    content_type="text/plain; version=0.0.4",
+                    charset="utf-8")
+
+
 @view_config(route_name='article_delete', permission='article_delete')
 def article_delete(context, request):
     """
@@ -73,7 +141,7 @@ def article_delete(context, request):
     c = ArticleLib()
     page_id = request.matchdict.get('page_id')
     try:
-        c.delete(request, c.show_page(page_id))
+        c.delete(request, c.show_page(page_id, request))
         request.session.flash(s.show_setting("INFO_DELETED")
                               % page_id, INFO)
         return redirect(request, "article_list")
@@ -90,7 +158,26 @@ def article_list(context, request):
     Show a list of articles
     """
     c = ArticleLib()
-    return {'pages': c.list()}
+    params = request.params
+    sort = params.get('sort', 'name')
+    descending = params.get('order') == 'desc'
+    private = params.get('private')
+    limit = int(request.registry.settings.get("article_list_per_page", 100))
+    filters = {'tag': params.get('tag'), 'owner': params.get('owner'),
+               'private': None if private is None else private == 'true'}
+    try:
+        pages, next_cursor = c.list_pages(limit, params.get('cursor'), sort,
+                                          descending, **filters)
+    except (ValueError, InvalidCursor):
+        sort = 'name'
+        pages, next_cursor = c.list_pages(limit, None, sort, descending,
+                                          **filters)
+    next_url = None
+    if next_cursor:
+        query = dict(params)
+        query['cursor'] = next_cursor
+        next_url = request.current_route_url(_query=query)
+    return {'pages': pages, 'next_url': next_url, 'sort': sort}
 
 
 @view_config(route_name='article_list_revisions',
@@ -104,12 +191,43 @@ def article_list_revisions(context, request):
     c = ArticleLib()
     page_id = request.matchdict.get('page_id')
     try:
-        page = c.show_page(page_id)
+        page = c.show_page(page_id, request)
     except PageNotFound:
         request.session.flash(s.show_setting("ERROR_NOT_FOUND")
                               % page_id, ERROR)
         return redirect(request, "article_list")
-    return {'page': page}
+    limit = int(request.registry.settings.get("article_revisions_per_page",
+                                              100))
+    try:
+        revisions, next_cursor = c.list_revisions(
+                                    page, limit, request.params.get('cursor'))
+    except InvalidCursor:
+        revisions, next_cursor = c.list_revisions(page, limit)
+    return {'page': page, 'revisions': revisions, 'next_cursor': next_cursor}
+
+
+@view_config(route_name='article_diff', permission='article_view',
+             renderer='article/article_diff.jinja2')
+def article_diff(context, request):
+    """
+    Show the changes between two revisions of an article
+    """
+    c = ArticleLib()
+    matchdict_get = request.matchdict.get
+    page_id = matchdict_get('page_id')
+    try:
+        page = c.show_page(page_id, request)
+        if page.private and not check_permission("set_private", context,
+                                                 request):
+            raise HTTPForbidden
+        rev_a, rev_b = int(matchdict_get('rev_a')), int(matchdict_get('rev_b'))
+        diff = c.diff(page, rev_a, rev_b)
+    except (PageNotFound, RevisionNotFound, ValueError):
+        request.session.flash(s.show_setting("ERROR_NOT_FOUND")
+                              % page_id, ERROR)
+        return redirect(request, "article_list")
+    return {'page': page, 'rev_a': rev_a, 'rev_b': rev_b,
+            'hunks': diff['hunks'], 'fast': diff['fast']}
 
 
 @view_config(route_name='article_update', permission='article_update',
@@ -136,7 +254,7 @@ def article_update(context, request):
         return redirect(request, "article_read", page_id=name)
 
     page_id = request.matchdict.get('page_id')
-    page = c.show_page(page_id)
+    page = c.show_page(page_id, request)
     revision = c.show_revision(page, request.matchdict.get('revision'))
     t = TagLib(ArticleTags, ARTICLE)
     display_name = page_id
@@ -144,7 +262,7 @@ def article_update(context, request):
     tags = ""
     if page:
         display_name = page.display_name
-        article = page.revisions[0].article
+        article = c.current_revision(page).article
         tags = t.get_tags(page)
     return rapid_deform(context, request, EditArticleSchema,
                         article_update_submit, page=page,
@@ -187,7 +305,7 @@ def article_revert(context, request):
     c = ArticleLib()
     matchdict_get = request.matchdict.get
     try:
-        page = c.show_page(matchdict_get('page_id'))
+        page = c.show_page(matchdict_get('page_id'), request)
         c.revert(request, page,
                  c.show_revision(page, matchdict_get('revision')),
                  u.show(get_username(request)))
@@ -207,7 +325,7 @@ def article_switch_renderer(context, request):
     """
     c = ArticleLib()
     page_id = request.matchdict.get('page_id')
-    c.switch_renderer(page_id)
+    c.switch_renderer(page_id, request)
     return redirect(request, "article_read", page_id=page_id)
 
 
@@ -229,31 +347,48 @@ def article_hide_display_name(context, request):
     """
     c = ArticleLib()
     page_id = request.matchdict.get('page_id')
-    c.hide_display_name(page_id)
+    c.hide_display_name(page_id, request)
     return redirect(request, "article_read", page_id=page_id)
 
 
 @view_config(route_name='article_add_vote', permission='vote')
 def article_add_vote(context, request):
     """
-    Add a vote to an article
+    Add or change a vote on an article, answering with the new tallies
+    as JSON for XMLHttpRequests
     """
     vote_id = request.matchdict.get('vote_id')
     like = request.matchdict.get('like').lower() == "true"
     a = ArticleLib()
-    article = a.show_page(vote_id)
-    try:
-        a.add_vote(article, u.show(get_username(request)), like)
+    article = a.show_page(vote_id, request)
+    result = a.set_vote(article, u.show(get_username(request)), like)
+    if request.is_xhr:
+        return render_to_response('json', result, request)
+    if result['changed']:
         request.session.flash(s.show_setting("INFO_VOTE"), INFO)
-    except AlreadyVoted:
+    else:
         request.session.flash(s.show_setting("ERROR_VOTE"), ERROR)
     return redirect(request, "article_read", page_id=vote_id)
 
 
 @view_config(route_name='userarea_admin_backup_articles', permission='backup')
 def userarea_admin_backup_articles(context, request):
+    """
+    Stream a backup of all articles.
+    Accepts: format=ndjson for one page per line, gzip=true to compress
+    """
     a = ArticleLib()
-    return display_json(request, a.to_json())
+    ndjson = request.params.get('format') == 'ndjson'
+    compress = request.params.get('gzip') == 'true'
+    filename = "articles.ndjson" if ndjson else "articles.json"
+    content_type = "application/x-ndjson" if ndjson else "application/json"
+    if compress:
+        filename += ".gz"
+        content_type = "application/gzip"
+    response = Response(content_type=content_type,
+                        app_iter=buffer_chunks(a.iter_json(ndjson), compress))
+    response.content_disposition = 'attachment; filename="%s"' % filename
+    return response
 
 
 @view_config(route_name='userarea_admin_restore_articles', permission='backup',
@@ -261,8 +396,7 @@ def userarea_admin_backup_articles(context, request):
 def userarea_admin_restore_articles(context, request):
     def restore_backup_submit(context, request, deserialized, bind_params):
         a = ArticleLib()
-        a.from_json(request, deserialized['restore_backup_json_file']
-        ['fp'].read().decode())
+        a.restore(request, deserialized['restore_backup_json_file']['fp'])
         return redirect(request, "article_list")
 
     result = rapid_deform(context, request, RestoreBackupSchema,
@@ -1,17 +1,19 @@
+from colander import Invalid
 from cornice import Service
 from cornice.validators import colander_body_validator
-from pyracms import WidgetLib
 from pyracms.lib.userlib import UserLib
 from pyracms.web_service_views import valid_token, valid_permission, APP_JSON
 
 from .deform_schemas.article import EditArticleSchema
-from .lib.articlelib import ArticleLib, PageNotFound, PageFound
+from .lib.responselib import conditional_response
+from .lib.viewcounter import view_counter
+from .lib.articlelib import (ArticleLib, PageNotFound, PageFound,
+                              InvalidCursor, RevisionNotFound)
 
 article = Service(name='api_article', path='/api/article/item/{page_id}',
                   description="Create, read, update, delete articles")
 c = ArticleLib()
 u = UserLib()
-w = WidgetLib()
 
 def quick_get_matchdict(request):
     page_id = request.matchdict.get('page_id') or "Front_Page"
@@ -23,7 +25,7 @@ def quick_get_matchdict(request):
 
 
 def check_owner(request, page_id):
-    page = c.show_page(page_id)
+    page = c.show_page(page_id, request)
     if (valid_permission(request, 'article_mod') or
         page.user == request.validated['user_db']):
         return True
@@ -33,15 +35,19 @@ def check_owner(request, page_id):
 
 @article.get()
 def api_article_read(request):
-    """Gets an article from the database."""
+    """
+    Gets an article from the database.
+    The revision list can be paged with revisions_limit and
+    revisions_cursor, the next cursor is in revision_list_next.
+    """
     page_id = request.matchdict.get('page_id') or "Front_Page"
     revision_id = request.params.get('revision')
     try:
-        page = c.show_page(page_id)
+        page = c.show_page(page_id, request)
         if revision_id:
             revision = c.show_revision(page, revision_id)
         else:
-            revision = page.revisions[0]
+            revision = c.current_revision(page)
         if not revision:
             request.errors.add('querystring', 'not_found', 'Revision not found')
             return
@@ -49,17 +55,32 @@ def api_article_read(request):
             request.errors.add('body', 'private', 'This page is private')
             return
         else:
+            view_counter.incr(page.id)
+            not_modified = conditional_response(
+                request, page, revision, False, page.current_revision_id,
+                request.query_string)
+            if not_modified:
+                return not_modified
+            limit = request.params.get('revisions_limit')
+            try:
+                rows, next_cursor = c.list_revisions(
+                    page, int(limit) if limit else None,
+                    request.params.get('revisions_cursor'))
+            except (InvalidCursor, ValueError):
+                request.errors.add('querystring', 'invalid_cursor',
+                                   'Invalid revisions_limit or cursor')
+                return
             revision_list = []
-            for rev in page.revisions:
+            for rev in rows:
                 revision_list.append({"summary": rev.summary,
                                       "revision_id": rev.id,
-                                      "user": rev.user.name,
+                                      "user": rev.username,
                                       "created": str(rev.created)})
             revision_dict = revision.to_dict()
-            revision_dict["rendered"] = w.render_article(page.renderer.name,
-                                                         revision.article)
+            revision_dict["rendered"] = c.render(page, revision)
             return {'page': page.to_dict(), 'revision': revision_dict,
-                    'revision_list': revision_list}
+                    'revision_list': revision_list,
+                    'revision_list_next': next_cursor}
     except PageNotFound:
         request.errors.add('querystring', 'not_found', 'Page Not Found')
 
@@ -99,7 +120,7 @@ def api_article_update(request):
         return
     user = request.validated['user_db']
     try:
-        page = c.show_page(page_id)
+        page = c.show_page(page_id, request)
         page.display_name = display_name
         c.update(request, page, article, summary, user, tags)
         return {"status": "updated"}
@@ -116,7 +137,7 @@ def api_article_delete(request):
     if not check_owner(request, page_id):
         return
     try:
-        c.delete(request, c.show_page(page_id))
+        c.delete(request, c.show_page(page_id, request))
         return {"status": "deleted"}
     except PageNotFound:
         request.errors.add('querystring', 'not_found', 'Page Not Found')
@@ -126,3 +147,259 @@ article_list = Service(name='api_article_list', path='/api/article/list')
 @article_list.get()
 def api_article_list(request):
     return c.list()
+
+
+article_pages = Service(name='api_article_pages', path='/api/article/pages',
+                        description="List articles a page at a time")
+@article_pages.get()
+def api_article_pages(request):
+    """
+    Lists articles.
+    Accepts: limit, cursor, sort (name, created, view_count, votes),
+    order (asc, desc), tag, owner, private (true, false)
+    """
+    params = request.params
+    private = params.get('private')
+    try:
+        limit = min(int(params.get('limit', 100)), 1000)
+        pages, next_cursor = c.list_pages(
+            limit, params.get('cursor'), params.get('sort', 'name'),
+            params.get('order') == 'desc', params.get('tag'),
+            params.get('owner'),
+            None if private is None else private == 'true')
+    except (ValueError, InvalidCursor):
+        request.errors.add('querystring', 'invalid',
+                           'Invalid limit, cursor or sort')
+        return
+    return {'pages': [{'name': page.name,
+                       'display_name': page.display_name or page.name,
+                       'created': str(page.created),
+                       'view_count': page.view_count,
+                       'up_count': page.up_count,
+                       'down_count': page.down_count,
+                       'private': page.private} for page in pages],
+            'next': next_cursor}
+
+
+batch = Service(name='api_article_batch', path='/api/article/batch',
+                description="Read many articles at once")
+@batch.get()
+def api_article_batch(request):
+    """
+    Gets many articles from the database, in the order asked for.
+    Accepts: name (repeated, up to article_batch_max_names), revisions
+    (true to include each page's revision list)
+    Returns: pages, each with page, revision and optionally
+    revision_list, and missing for names not found or private.
+    Views are not counted.
+    """
+    names = request.params.getall('name')
+    max_names = int(request.registry.settings.get("article_batch_max_names",
+                                                  100))
+    if len(names) > max_names:
+        request.errors.add('querystring', 'too_many',
+                           'At most %s names can be read at once' % max_names)
+        return
+    pages = c.show_pages(names, request)
+    found = [page for page in pages.values() if not page.private]
+    revision_lists = {}
+    if request.params.get('revisions') == 'true':
+        revision_lists = c.list_revisions_multi(
+                                        set([page.id for page in found]))
+    result = []
+    missing = []
+    for name in names:
+        page = pages.get(name)
+        if page is None or page.private:
+            missing.append(name)
+            continue
+        revision = c.current_revision(page)
+        revision_dict = revision.to_dict()
+        revision_dict["rendered"] = c.render(page, revision)
+        item = {'page': page.to_dict(), 'revision': revision_dict}
+        if page.id in revision_lists:
+            item['revision_list'] = [{"summary": rev.summary,
+                                      "revision_id": rev.id,
+                                      "user": rev.username,
+                                      "created": str(rev.created)}
+                                     for rev in revision_lists[page.id]]
+        result.append(item)
+    return {'pages': result, 'missing': missing}
+
+
+bulk = Service(name='api_article_bulk', path='/api/article/bulk',
+               description="Create or update many articles at once")
+@bulk.post(content_type=APP_JSON, validators=valid_token)
+def api_article_bulk(request):
+    """
+    Creates or updates many articles in one transaction.
+    Accepts: items, a list of up to article_bulk_max_items objects with
+    page_id, display_name, article, summary, tags
+    Returns: results, with page_id and status (created, updated) or error
+    for each item in order.
+    """
+    can_create = valid_permission(request, "article_create")
+    can_update = valid_permission(request, "article_update")
+    if not can_create and not can_update:
+        request.errors.add('body', 'access_denied', 'Access denied')
+        return
+    body = request.json_body
+    items = body.get('items') if isinstance(body, dict) else None
+    max_items = int(request.registry.settings.get("article_bulk_max_items",
+                                                  1000))
+    if not isinstance(items, list) or len(items) > max_items:
+        request.errors.add('body', 'items',
+                           'items must be a list of at most %s' % max_items)
+        return
+    schema = EditArticleSchema()
+    results = [None] * len(items)
+    valid = []
+    positions = []
+    for i, item in enumerate(items):
+        page_id = isinstance(item, dict) and item.get('page_id')
+        if not page_id:
+            results[i] = {'page_id': page_id or None,
+                          'error': {'page_id': 'Required'}}
+            continue
+        if not isinstance(page_id, str):
+            results[i] = {'page_id': page_id,
+                          'error': {'page_id': 'Must be a string'}}
+            continue
+        try:
+            data = schema.deserialize(item)
+        except Invalid as e:
+            results[i] = {'page_id': page_id, 'error': e.asdict()}
+            continue
+        data['page_id'] = page_id
+        valid.append(data)
+        positions.append(i)
+    saved = c.bulk_save(request, valid, request.validated['user_db'],
+                        can_create, can_update,
+                        valid_permission(request, 'article_mod'))
+    for i, result in zip(positions, saved):
+        results[i] = result
+    return {'results': results}
+
+
+diff = Service(name='api_article_diff',
+               path='/api/article/diff/{page_id}/{rev_a}/{rev_b}',
+               description="Compare two revisions of an article")
+@diff.get()
+def api_article_diff(request):
+    """
+    Diffs two revisions of an article.
+    Returns: hunks, each with a_start, a_end, b_start, b_end, lines as
+    [op, text] pairs where op is " ", "-" or "+", and words as lists of
+    [op, text] pairs for replaced lines. fast is true when the texts were
+    too big for a full diff.
+    """
+    matchdict_get = request.matchdict.get
+    try:
+        page = c.show_page(matchdict_get('page_id'), request)
+        if page.private:
+            request.errors.add('body', 'private', 'This page is private')
+            return
+        return c.diff(page, int(matchdict_get('rev_a')),
+                      int(matchdict_get('rev_b')))
+    except PageNotFound:
+        request.errors.add('querystring', 'not_found', 'Page Not Found')
+    except (RevisionNotFound, ValueError):
+        request.errors.add('querystring', 'not_found', 'Revision not found')
+
+
+tag_cloud = Service(name='api_article_tags', path='/api/article/tags',
+                    description="Tag cloud")
+@tag_cloud.get()
+def api_article_tags(request):
+    """
+    Lists tags with the number of public pages using each, most used
+    first.
+    Accepts: limit
+    """
+    try:
+        limit = min(int(request.params.get('limit', 100)), 1000)
+    except ValueError:
+        request.errors.add('querystring', 'invalid', 'Invalid limit')
+        return
+    return {'tags': [{'name': name, 'count': count}
+                     for name, count in c.tag_counts(limit)]}
+
+
+tag_pages = Service(name='api_article_tag_pages',
+                    path='/api/article/tag/{tag}',
+                    description="List public articles with a tag")
+@tag_pages.get()
+def api_article_tag_pages(request):
+    """
+    Lists public articles with a tag.
+    Accepts: limit, cursor, sort (name, created, view_count, votes),
+    order (asc, desc)
+    """
+    params = request.params
+    try:
+        limit = min(int(params.get('limit', 100)), 1000)
+        pages, next_cursor = c.list_pages(
+            limit, params.get('cursor'), params.get('sort', 'name'),
+            params.get('order') == 'desc', request.matchdict['tag'],
+            private=False)
+    except (ValueError, InvalidCursor):
+        request.errors.add('querystring', 'invalid',
+                           'Invalid limit, cursor or sort')
+        return
+    return {'pages': [{'name': page.name,
+                       'display_name': page.display_name or page.name,
+                       'created': str(page.created)} for page in pages],
+            'next': next_cursor}
+
+
+related = Service(name='api_article_related',
+                  path='/api/article/related/{page_id}',
+                  description="List articles sharing tags with an article")
+@related.get()
+def api_article_related(request):
+    """
+    Lists public articles sharing tags with an article, most shared
+    tags first.
+    Accepts: limit
+    """
+    try:
+        page = c.show_page(request.matchdict.get('page_id'), request)
+        limit = min(int(request.params.get('limit', 10)), 100)
+    except PageNotFound:
+        request.errors.add('querystring', 'not_found', 'Page Not Found')
+        return
+    except ValueError:
+        request.errors.add('querystring', 'invalid', 'Invalid limit')
+        return
+    if page.private:
+        request.errors.add('body', 'private', 'This page is private')
+        return
+    return {'pages': [{'name': row.name,
+                       'display_name': row.display_name or row.name,
+                       'shared_tags': row.shared}
+                      for row in c.related_pages(page, limit)]}
+
+
+vote = Service(name='api_article_vote', path='/api/article/vote/{page_id}',
+               description="Vote on articles")
+@vote.post(content_type=APP_JSON, validators=valid_token)
+def api_article_vote(request):
+    """
+    Adds or changes the user's vote on an article.
+    Accepts: like (true or false)
+    Returns: up_count, down_count, like, changed
+    """
+    if not valid_permission(request, "vote"):
+        request.errors.add('body', 'access_denied', 'Access denied')
+        return
+    try:
+        page = c.show_page(request.matchdict.get('page_id'), request)
+    except PageNotFound:
+        request.errors.add('querystring', 'not_found', 'Page Not Found')
+        return
+    body = request.json_body
+    if not isinstance(body, dict):
+        request.errors.add('body', 'like', 'Body must be an object')
+        return
+    like = body.get('like') in (True, "true", "True")
+    return c.set_vote(page, request.validated['user_db'], like)
@@ -40,5 +40,13 @@ setup(name='pyracms_article',
       main = pyracms_article:main
       [console_scripts]
       initialize_pyracms_article_db = pyracms_article.scripts.initializedb:main
+      upgrade_pyracms_article_db = pyracms_article.scripts.upgradedb:main
+      rerender_pyracms_article_db = pyracms_article.scripts.rerender:main
+      restore_pyracms_article_db = pyracms_article.scripts.restore:main
+      article_index_worker = pyracms_article.scripts.indexworker:main
+      reconcile_pyracms_article_votes = pyracms_article.scripts.reconcilevotes:main
+      pack_pyracms_article_revisions = pyracms_article.scripts.packrevisions:main
+      compact_pyracms_article_revisions = pyracms_article.scripts.compactrevisions:main
+      benchmark_pyracms_article = pyracms_article.scripts.benchmark:main
       """,
       )